@@ -0,0 +1,64 @@
+__author__ = 'Gian Paolo Jesi'
+
+from util.game_gen import g_struct, deck_struct, estimate_states, deck_permutations, \
+    get_bforce_graph
+from util.game_vec import deck_graph
+from multiprocessing import Process, Queue, cpu_count
+from resource import getrusage, RUSAGE_SELF
+from timeit import default_timer as timer
+
+"""
+Scaling benchmark of the game graph generators on TTT variants with growing decks. Each run takes
+place in a fresh process, so that the reported peak RSS belongs to that run only (the worker
+processes of the parallel Python engine are not accounted). The 'python-mp' engine runs the
+brute-force expansion of the Python engine on a process pool, one worker for each CPU: its
+speedup over 'python' is reported.
+"""
+
+PYTHON_LIMIT = 400000  # the Python engines are benchmarked up to this many states
+
+
+def _run(engine, numbers, queue):
+    struct = deck_struct(g_struct, numbers)
+
+    start = timer()
+    if engine in ('python', 'python-mp'):
+        processes = cpu_count() if engine == 'python-mp' else None
+        state_map, edges = get_bforce_graph(deck_permutations(struct), struct, processes)
+        n_states, n_edges = len(state_map), len(edges)
+    else:
+        states, src, dst, move = deck_graph(struct, strategy='bforce')
+        n_states, n_edges = len(states), len(src)
+    end = timer()
+
+    queue.put((n_states, n_edges, end - start, getrusage(RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def bench(engine, numbers):
+    # a plain process rather than a pool one, which could not start the workers of python-mp
+    queue = Queue()
+    process = Process(target=_run, args=(engine, numbers, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    print "%9s %6s %10s %10s %8s %12s %12s %10s %8s" % (
+        'engine', 'cards', 'states', 'edges', 'time', 'states/s', 'edges/s', 'RSS (MB)', 'speedup')
+    for top in range(4, 8):
+        numbers = range(2, top + 1)
+        serial = None
+        for engine in ('python', 'python-mp', 'numpy'):
+            if engine != 'numpy' and estimate_states(deck_struct(g_struct, numbers)) > \
+                    PYTHON_LIMIT:
+                continue
+
+            n_states, n_edges, elapsed, rss = bench(engine, numbers)
+            if engine == 'python':
+                serial = elapsed
+            speedup = "%8.2f" % (serial / elapsed) if engine == 'python-mp' else ''
+            print "%9s %6d %10d %10d %8.3f %12.0f %12.0f %10.1f %8s" % (
+                engine, 2 * len(numbers), n_states, n_edges, elapsed, n_states / elapsed,
+                n_edges / elapsed, rss, speedup)
@@ -1,102 +1,473 @@
 from graph_tool.all import *
 from numpy.random import random
 import matplotlib as pl
-import ast
+from hashlib import md5, sha1
+from multiprocessing import Pool
+from os import rename
+from os.path import getsize, getmtime, exists
+from struct import unpack
+import cPickle as pickle
+import numpy as np
+import re
+from util.algo import terminal_states
 
 __author__ = 'Gian Paolo Jesi'
 _MATLAB_CARD_LAYOUT = ("ck", "target", "nk", "dc", "up", "dn", "player")
+_CACHE_FORMAT = 2  # version of the graph cache files, see BasicLoader.load_matrix
 
+# top level items of a matrix line: a {...} group of strings or a single string
+_ITEM = re.compile(r'\s*(?:\{([^{}]*)\}|"([^"]*)"|\'([^\']*)\')\s*(,|\Z)')
+_STRING = re.compile(r'\s*(?:"([^"]*)"|\'([^\']*)\')\s*(,|\Z)')
 
-class LeafVertexDetector(DFSVisitor):
-    def __init__(self, leaf, target=None):
-        self.leaf = leaf
-        self.target = target
 
-    def discover_vertex(self, u):
-        # print "Check node %d: ind: %d, outd: %d" % (u, u.in_degree(), u.out_degree())
-        if u.out_degree() == 0:
-            self.leaf[u] = True
-            print "detected leaf node: ", u
+def _scan(pattern, text):
+    """
+    Match the comma separated items of text one after the other: any text that is not part of an
+    item is an error.
+
+    :return: the list of the match objects
+    """
+    if not text.strip():
+        return []
+
+    matches, pos = [], 0
+    while True:
+        m = pattern.match(text, pos)
+        if m is None:
+            raise ValueError("unexpected text at %d: %s" % (pos, text[pos:]))
+        matches.append(m)
+        pos = m.end()
+        if not m.group(m.lastindex):  # the end of the text, not a comma
+            return matches
+
+
+def tokenize_matrix_line(line):
+    """
+    Split a line of the matrix files, such as {{"3H", "4C", ...}, {"2H", "4C", ...}, "U"} or
+    {"ABCD", "ABDC", "D"}, into its items without evaluating it.
+
+    :param line: the text line
+    :return: a list with an item for each top level element: a tuple of strings for the {...}
+    groups, a string otherwise
+    :raise ValueError: when the line holds anything else than quoted strings and {...} groups of
+    quoted strings separated by commas
+    """
+    text = line.strip()
+    if not text.startswith('{') or not text.endswith('}'):
+        raise ValueError("Malformed matrix line: %s" % text)
+
+    items = []
+    try:
+        for m in _scan(_ITEM, text[1:-1]):
+            group, double, single = m.group(1, 2, 3)
+            if group is not None:
+                items.append(tuple([s.group(1) if s.group(1) is not None else s.group(2)
+                                    for s in _scan(_STRING, group)]))
+            else:
+                items.append(double if double is not None else single)
+    except ValueError as e:
+        raise ValueError("Malformed matrix line: %s (%s)" % (text, e))
+
+    return items
+
+
+def _file_signature(filename):
+    """
+    Size, modification time and sha1 digest of a file, identifying the source of a graph cache.
+    """
+    h = sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            h.update(block)
+
+    return getsize(filename), getmtime(filename), h.hexdigest()
+
+
+def _key_hash(key):
+    """
+    64 bits hash of a node state key: the parse workers identify the states by it.
+    """
+    return unpack('<Q', md5(repr(key)).digest()[:8])[0]
+
+
+def _line_chunks(filename, chunk_size):
+    """
+    Split a file into byte ranges of about chunk_size bytes, ending on line boundaries.
+
+    :return: a list of (start, end) offsets
+    """
+    size = getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_size, size) - 1)
+            f.readline()
+            bounds.append(min(f.tell(), size))
+
+    return zip(bounds[:-1], bounds[1:])
+
+
+_worker_loader = None  # loader instance of the parse worker processes
+
+
+def _init_parse_worker(loader_class):
+    global _worker_loader
+    _worker_loader = loader_class()
+
+
+def _parse_chunk(task):
+    """
+    Parse a byte range of a matrix file in a worker process.
+
+    :param task: a triplet (filename, start, end)
+    :return: a tuple (lines, a_hash, b_hash, move, moves, edge_line, states): the number of lines
+    of the range; the state hashes, move codes and line numbers of its edges as arrays; the move
+    names of the codes and the states first seen in the range as (hash, key, data, line) tuples
+    """
+    filename, start, end = task
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+
+    parse_line = _worker_loader.parse_line
+    seen, states, moves = dict(), [], dict()
+    a_hash, b_hash, move, edge_line = [], [], [], []
+    for number, line in enumerate(lines):
+        if not line.strip():
+            continue
+
+        a_key, a_data, b_key, b_data, m = parse_line(line)
+        for key, data, hashes in ((a_key, a_data, a_hash), (b_key, b_data, b_hash)):
+            h = seen.get(key)
+            if h is None:
+                h = seen[key] = _key_hash(key)
+                states.append((h, key, data, number))
+            hashes.append(h)
+
+        move.append(moves.setdefault(m, len(moves)))
+        edge_line.append(number)
+
+    moves = sorted(moves, key=moves.get)
+    return (len(lines), np.array(a_hash, dtype=np.uint64), np.array(b_hash, dtype=np.uint64),
+            np.array(move, dtype=np.int64), moves, np.array(edge_line, dtype=np.int64), states)
+
+
+class Vocabulary(object):
+    """
+    Maps the strings of a categorical property (card values, moves) to uint8 codes, in first seen
+    order. Code 0 is the empty string, the value of the unset properties.
+    """
+
+    def __init__(self, names=('',)):
+        self.names = list(names)
+        self.codes = dict((name, i) for i, name in enumerate(self.names))
+
+    def code(self, name):
+        """
+        Code of a string, adding it to the vocabulary when new.
+        """
+        code = self.codes.get(name)
+        if code is None:
+            if len(self.names) > np.iinfo(np.uint8).max:
+                raise ValueError("Too many distinct values for an uint8 property: %s" % name)
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+
+        return code
+
+    def encode(self, names):
+        """
+        Vectorized lookup of known strings.
+
+        :param names: a string or a sequence of strings
+        :return: the uint8 codes as a NumPy array
+        """
+        known = np.array(self.names)
+        order = np.argsort(known)
+        names = np.asarray(names)
+        pos = np.minimum(np.searchsorted(known[order], names), len(known) - 1)
+        if not (known[order][pos] == names).all():
+            raise ValueError("Unknown values: %s" % names)
+
+        return order[pos].astype(np.uint8)
+
+    def decode(self, codes):
+        """
+        :param codes: an array of codes, e.g. the .a array of a property map
+        :return: the NumPy array of the strings
+        """
+        return np.array(self.names)[codes]
+
+    def labels(self, prop):
+        """
+        Make a string property map with the decoded values of a coded property, for drawing.
+        """
+        g = prop.get_graph()
+        if prop.key_type() == 'e':
+            labels, items = g.new_edge_property('string'), g.edges()
+        else:
+            labels, items = g.new_vertex_property('string'), g.vertices()
+        for item in items:
+            labels[item] = self.names[prop[item]]
 
-        # 2H is in target zone:
-        if self.target and self.target[u] == '2H':
-            self.leaf[u] = True
-            print "detected leaf node: ", u
+        return labels
 
 
 class BasicLoader(object):
     def __init__(self):
         self.index = dict()  # maps lists (node states) to name index
+        self.properties = ()  # names of the vertex properties filled from the node states
+        self.values = Vocabulary()  # codes of the uint8 vertex properties
+        self.moves = Vocabulary()  # codes of the 'move' edge property
         self.g = Graph()
         # internal property for edges:
-        self.g.edge_properties['move'] = self.g.new_edge_property("string")
-
-    def load_matrix(self, filename='', limit=-1):
+        self.g.edge_properties['move'] = self.g.new_edge_property("uint8_t")
+
+    def parse_line(self, line):
+        """
+        Parse a matrix line, see tokenize_matrix_line.
+
+        :return: a tuple (a_key, a_data, b_key, b_data, move): the keys of the two node states in
+        the index and their values, in the order of self.properties
+        """
+        raise NotImplementedError
+
+    def load_matrix(self, filename='', limit=-1, processes=1, chunk_size=1 << 22, progress=None,
+                    cache=True):
+        """
+        Load a matrix file. The lines are tokenized into plain lists and the graph is built at the
+        end in a single batch: the edges are committed by add_edge_list.
+        The loaded graph is saved in binary format next to the source file (filename.gt, along
+        with the index keys in filename.index, or filename.limitN.gt and filename.limitN.index
+        for a limited load) and reloaded from there while the source file is
+        unchanged.
+
+        :param filename: the matrix file
+        :param limit: stop before line number limit. Default: no limit
+        :param processes: number of worker processes parsing the file in chunks. None means one
+            for each CPU. Default: parse in this process
+        :param chunk_size: approximate size in bytes of the chunks parsed by the workers
+        :param progress: optional callable receiving (bytes read, file size) from time to time
+        :param cache: use and refresh the binary cache of the graph. Default: enabled
+        """
         assert filename != ''
 
-        counter = 1
         # reset the index to avoid conflicts
         self.index.clear()
         self.index['counter'] = 0
+        self.values, self.moves = Vocabulary(), Vocabulary()
         self.g.clear()
 
         try:
-            with open(filename, 'r') as f:
-                for line in f:
-                    if limit != -1 and counter >= limit: break
+            signature = (_CACHE_FORMAT, type(self).__name__, tuple(self.properties), limit,
+                         _file_signature(filename)) if cache else None
+            cache_name = filename if limit == -1 else '%s.limit%d' % (filename, limit)
+            if cache and self._load_cache(cache_name, signature):
+                print "Loaded %d nodes and %d edges from %s.gt" % (
+                    self.index['counter'], self.g.num_edges(), cache_name)
+                return
+
+            if processes == 1:
+                loaded = self._read_lines(filename, limit, progress)
+            else:
+                loaded = self._read_chunks(filename, limit, processes, chunk_size, progress)
+        except IOError as ioe:
+            print ioe
+            return
 
-                    print "processing line %d: %s" % (counter, line)
-                    counter += 1
+        keys, rows, edges, moves = loaded
+        self._commit(keys, rows, edges, moves)
+        print "Loaded %d nodes and %d edges from %s" % (len(keys), len(edges), filename)
+        if cache:
+            self._save_cache(cache_name, signature, keys)
 
-                    self.make_gt_line(line)
+    def _load_cache(self, filename, signature):
+        """
+        Load the graph and the index from the cache files (filename.gt and filename.index), when
+        they match the signature of the source file and of the load parameters.
 
-        except IOError as ioe:
-            print ioe
+        :return: True on success
+        """
+        if not exists(filename + '.gt') or not exists(filename + '.index'):
+            return False
+
+        try:
+            with open(filename + '.index', 'rb') as f:
+                stored, keys = pickle.load(f)
+            if stored != signature:
+                return False
+            self.g.load(filename + '.gt')
+        except Exception as e:  # a broken cache is just rebuilt
+            print "Warning: discarding the graph cache of %s: %s" % (filename, e)
+            self.g.clear()
+            return False
+
+        for i, key in enumerate(keys):
+            self.index[key] = self.g.vertex(i)
+        self.index['counter'] = len(keys)
+        self.values = Vocabulary(self.g.graph_properties['values'])
+        self.moves = Vocabulary(self.g.graph_properties['moves'])
+        return True
+
+    def _save_cache(self, filename, signature, keys):
+        try:
+            self.g.save(filename + '.gt.tmp', fmt='gt')
+            with open(filename + '.index.tmp', 'wb') as f:
+                pickle.dump((signature, keys), f, pickle.HIGHEST_PROTOCOL)
+            rename(filename + '.gt.tmp', filename + '.gt')
+            rename(filename + '.index.tmp', filename + '.index')
+        except EnvironmentError as e:  # IOError, or OSError from rename
+            print "Warning: cannot write the graph cache %s: %s" % (filename, e)
+
+    def _read_lines(self, filename, limit, progress):
+        counter = 1
+        size = getsize(filename)
+        done = 0
+        names = dict()  # node state key -> vertex position
+        keys, rows, edges, moves = [], [], [], []
+        with open(filename, 'r') as f:
+            for line in f:
+                if limit != -1 and counter >= limit: break
+
+                counter += 1
+                done += len(line)
+                if progress and counter % 100000 == 0:
+                    progress(done, size)
+                if not line.strip():
+                    continue
+
+                a_key, a_data, b_key, b_data, m = self.parse_line(line)
+                for key, data in ((a_key, a_data), (b_key, b_data)):
+                    if key not in names:
+                        names[key] = len(keys)
+                        keys.append(key)
+                        rows.append(data)
+
+                edges.append((names[a_key], names[b_key]))
+                moves.append(m)
+
+        if progress:
+            progress(done, size)
+        return keys, rows, edges, moves
+
+    def _read_chunks(self, filename, limit, processes, chunk_size, progress):
+        """
+        Parse the file in chunks with a process pool and merge the results in file order, so that
+        the vertexes get the same positions as in _read_lines. The workers identify the states by
+        a hash: just the states first seen in a chunk are sent along with their data.
+        """
+        max_lines = limit - 1 if limit != -1 else None
+        size = getsize(filename)
+        chunks = _line_chunks(filename, chunk_size)
+
+        positions = dict()  # state hash -> vertex position
+        keys, rows, hashes = [], [], []
+        a_hashes, b_hashes, move_codes = [], [], []
+        move_index = dict()  # move name -> global move code
+        base = 0
+
+        pool = Pool(processes, initializer=_init_parse_worker, initargs=(type(self),))
+        try:
+            results = pool.imap(_parse_chunk, [(filename, start, end) for start, end in chunks])
+            for (start, end), result in zip(chunks, results):
+                lines, a_hash, b_hash, move, moves, edge_line, states = result
+                if max_lines is not None and base + lines > max_lines:
+                    keep = base + edge_line < max_lines
+                    a_hash, b_hash, move = a_hash[keep], b_hash[keep], move[keep]
+                    states = [item for item in states if base + item[3] < max_lines]
+
+                for h, key, data, line in states:
+                    position = positions.get(h)
+                    if position is None:
+                        positions[h] = len(keys)
+                        keys.append(key)
+                        rows.append(data)
+                        hashes.append(h)
+                    elif keys[position] != key:
+                        raise ValueError("Hash collision between states %s and %s" %
+                                         (keys[position], key))
+
+                codes = [move_index.setdefault(m, len(move_index)) for m in moves]
+                a_hashes.append(a_hash)
+                b_hashes.append(b_hash)
+                move_codes.append(np.array(codes, dtype=np.int64)[move] if len(move) else move)
+
+                base += lines
+                if progress:
+                    progress(end, size)
+                if max_lines is not None and base >= max_lines:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if not keys:
+            return [], [], [], []
+
+        hashes = np.array(hashes, dtype=np.uint64)
+        order = np.argsort(hashes)
+        sorted_hashes = hashes[order]
+        edges = np.column_stack([order[np.searchsorted(sorted_hashes, np.concatenate(item))]
+                                 for item in (a_hashes, b_hashes)])
+        names = sorted(move_index, key=move_index.get)
+        moves = [names[code] for code in np.concatenate(move_codes)]
+        return keys, rows, edges, moves
+
+    def _commit(self, keys, rows, edges, moves):
+        """
+        Add the loaded vertexes and edges to the (empty) graph and fill the index.
+        """
+        g = self.g
+        if keys:
+            g.add_vertex(len(keys))
+
+        # string properties are set one by one, the uint8 ones get columns of codes:
+        props = [g.vertex_properties[name] for name in self.properties]
+        columns = [None if prop.value_type() == 'string' else np.zeros(len(keys), dtype=np.uint8)
+                   for prop in props]
+        code = self.values.code
+        for i, (key, data) in enumerate(zip(keys, rows)):
+            v = g.vertex(i)
+            for prop, column, value in zip(props, columns, data):
+                if column is None:
+                    prop[v] = value
+                else:
+                    column[i] = code(value)
+            self.index[key] = v
+        self.index['counter'] = len(keys)
+
+        for prop, column in zip(props, columns):
+            if column is not None:
+                prop.a[:] = column
+
+        if len(edges):
+            g.add_edge_list(np.array(edges, dtype=np.int64))
+            # the edges of the empty graph get the indexes 0, 1, ... in order:
+            g.edge_properties['move'].a[:] = [self.moves.code(m) for m in moves]
+
+        g.graph_properties['values'] = g.new_graph_property('vector<string>', self.values.names)
+        g.graph_properties['moves'] = g.new_graph_property('vector<string>', self.moves.names)
 
 
 class GTLoader(BasicLoader):
     def __init__(self):
         super(GTLoader, self).__init__()
+        self.properties = _MATLAB_CARD_LAYOUT
         # making internal properties for vertex:
         for item in _MATLAB_CARD_LAYOUT:
-            self.g.vertex_properties[item] = self.g.new_vertex_property("string")
-
-    def make_gt_line(self, line):
-        line = line.replace('{', '[')
-        line = line.replace('}', ']')
-
-        a_data, b_data, m = ast.literal_eval(line)
-        params_a = dict(zip(_MATLAB_CARD_LAYOUT, a_data))
-        params_b = dict(zip(_MATLAB_CARD_LAYOUT, b_data))
-
-        if a_data.__repr__() not in self.index.keys():
-            self.index['counter'] += 1
-            v = self.g.add_vertex()
-            for key in params_a.keys():
-                self.g.vertex_properties[key][v] = params_a[key]
-            self.index[a_data.__repr__()] = v
-
-            print "Inserting: %s with name: %d" % (a_data.__repr__(), self.g.vertex_index[v])
-        else:
-            print "data %s already in" % a_data.__repr__()
-            pass
-
-        if b_data.__repr__() not in self.index.keys():
-            self.index['counter'] += 1
-            v = self.g.add_vertex()
-            for key in params_b.keys():
-                self.g.vertex_properties[key][v] = params_b[key]
-            self.index[b_data.__repr__()] = v
-            print "Inserting: %s with name: %d" % (b_data.__repr__(), self.g.vertex_index[v])
-        else:
-            print "data %s already in" % b_data.__repr__()
-            pass
+            self.g.vertex_properties[item] = self.g.new_vertex_property("uint8_t")
 
-        ab = self.g.add_edge(self.index[a_data.__repr__()], self.index[b_data.__repr__()])
-        self.g.edge_properties['move'][ab] = m
+    def parse_line(self, line):
+        a_data, b_data, m = tokenize_matrix_line(line)
+        # node states are indexed by the repr of their value lists:
+        return repr(list(a_data)), a_data, repr(list(b_data)), b_data, m
 
-    def load_matrix(self, filename="data/TTT-matrix.txt", limit=-1):
-        super(GTLoader, self).load_matrix(filename, limit)
+    def load_matrix(self, filename="data/TTT-matrix.txt", limit=-1, processes=1, progress=None,
+                    cache=True):
+        super(GTLoader, self).load_matrix(filename, limit, processes, progress=progress,
+                                          cache=cache)
 
     def show_betweeness(self):
         assert self.g.num_vertices(ignore_filter=True) > 0
@@ -104,7 +475,7 @@ class GTLoader(BasicLoader):
         gv = GraphView(self.g)
         pos = sfdp_layout(gv, gamma=1.5)
         bv, be = betweenness(gv)
-        move = gv.edge_properties['move']
+        move = self.moves.labels(gv.edge_properties['move'])
         vc_map = pl.cm.gist_heat
         graph_draw(gv, pos, vertex_size=prop_to_size(bv, mi=1, ma=15), output_size=(1000, 1000),
                    vertex_fill_color=bv, edge_text=move, edge_text_size=8,
@@ -116,7 +487,7 @@ class GTLoader(BasicLoader):
         gv = GraphView(self.g)
         pos = sfdp_layout(gv, gamma=1.5)
         tree = min_spanning_tree(gv)
-        move = gv.edge_properties['move']
+        move = self.moves.labels(gv.edge_properties['move'])
         if filter:
             gv.set_edge_filter(tree)
 
@@ -128,14 +499,14 @@ class GTLoader(BasicLoader):
 
         gv = GraphView(self.g)
         # new properties:
-        leaf = gv.new_vertex_property('bool')
         gv.edge_properties['asp'] = gv.new_edge_property('bool')  # internal prop
 
         target = gv.vertex_properties['target']
-        move = gv.edge_properties['move']
+        move = self.moves.labels(gv.edge_properties['move'])
 
-        dfs_search(gv, gv.vertex(0), LeafVertexDetector(leaf, target))
-        print "Available leaf nodes: %d" % sum([item for item in leaf.a if item == 1])
+        # leaf nodes: no moves left or 2H in the target zone
+        leaf = terminal_states(gv, target, self.values.codes.get('2H'))
+        print "Available leaf nodes: %d" % leaf.a.sum()
         print gv.edge_properties
         print gv.list_properties()
 
@@ -167,7 +538,7 @@ class GTLoader(BasicLoader):
         assert self.g.num_vertices(ignore_filter=True) > 0
         gv = GraphView(self.g)
         pos = sfdp_layout(gv, gamma=1.5)
-        move = gv.edge_properties['move']
+        move = self.moves.labels(gv.edge_properties['move'])
 
         vl, el = shortest_path(gv, gv.vertex(0), gv.vertex(1000))
 
@@ -177,8 +548,7 @@ class GTLoader(BasicLoader):
 
 if __name__ == '__main__':
     ldr = GTLoader()
-    ldr.load_matrix()
-    # ldr.g.load('data/TTTg.xml.gz')
+    ldr.load_matrix()  # reloaded from data/TTT-matrix.txt.gt when unchanged
     ldr.show_betweeness()
     # ldr.show_min_span_tree(filter=True)
     # ldr.show_start_end_path()
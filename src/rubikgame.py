@@ -1,9 +1,8 @@
 __author__ = 'Gian Paolo Jesi'
 
 from graph_tool.all import *
-import ast
-from loader import BasicLoader
-from util.algo import spanning, split_check
+from loader import BasicLoader, tokenize_matrix_line
+from util.algo import spanning, split_check, AnalysisCache
 
 
 class RubikLoader(BasicLoader):
@@ -14,60 +13,27 @@ class RubikLoader(BasicLoader):
         for item in properties:
             self.g.vertex_properties[item] = self.g.new_vertex_property("string")
 
-    def make_gt_line(self, line):
-        line = line.replace('{', '[')
-        line = line.replace('}', ']')
-
-        a_data, b_data, m = ast.literal_eval(line)
+    def parse_line(self, line):
+        a_data, b_data, m = tokenize_matrix_line(line)
 
         # when a and b are simple strings, convert them to a sequence of a
         # single element
-        if type(a_data) is str:
-            print "converting to seq"
-            params_a = dict(zip(self.properties, (a_data,)))
-        else:
-            params_a = dict(zip(self.properties, a_data))
-
-        if type(b_data) is str:
-            params_b = dict(zip(self.properties, (b_data,)))
-        else:
-            params_b = dict(zip(self.properties, b_data))
-
-        if a_data not in self.index.keys():
-            self.index['counter'] += 1
-            v = self.g.add_vertex()
-            for key in params_a.keys():
-                self.g.vertex_properties[key][v] = params_a[key]
-            self.index[a_data] = v
-
-            print "Inserting: %s with name: %d" % (a_data, self.g.vertex_index[v])
-        else:
-            print "data %s already in" % a_data
-            pass
-
-        if b_data not in self.index.keys():
-            self.index['counter'] += 1
-            v = self.g.add_vertex()
-            for key in params_b.keys():
-                self.g.vertex_properties[key][v] = params_b[key]
-            self.index[b_data] = v
-            print "Inserting: %s with name: %d" % (b_data, self.g.vertex_index[v])
-        else:
-            print "data %s already in" % b_data
-            pass
+        params_a = (a_data,) if type(a_data) is str else a_data
+        params_b = (b_data,) if type(b_data) is str else b_data
 
-        ab = self.g.add_edge(self.index[a_data], self.index[b_data])
-        self.g.edge_properties['move'][ab] = m
+        return a_data, params_a, b_data, params_b, m
 
-    def load_matrix(self, filename="data/MiniRubik.txt", limit=-1):
-        super(RubikLoader, self).load_matrix(filename, limit)
+    def load_matrix(self, filename="data/MiniRubik.txt", limit=-1, processes=1, progress=None,
+                    cache=True):
+        super(RubikLoader, self).load_matrix(filename, limit, processes, progress=progress,
+                                             cache=cache)
 
     def draw(self):
         assert self.g.num_vertices(ignore_filter=True) > 0
 
         gv = GraphView(self.g)
         pos = sfdp_layout(gv, gamma=1.5)
-        move = gv.edge_properties['move']
+        move = self.moves.labels(gv.edge_properties['move'])
         name = gv.vertex_properties['name']
         # vcmap = pl.cm.gist_heat
         graph_draw(gv, pos, output_size=(1000, 1000),
@@ -80,7 +46,7 @@ class RubikLoader(BasicLoader):
 
         gv = GraphView(self.g)
         pos = sfdp_layout(gv, gamma=1.5)
-        move = gv.edge_properties['move']
+        move = self.moves.labels(gv.edge_properties['move'])
         name = gv.vertex_properties['name']
 
         v1 = gv.vertex_index[self.index[v1]]
@@ -113,11 +79,12 @@ class RubikLoader(BasicLoader):
         graph_draw(gv, pos, output_size=(1000, 1000),
                    edge_text=move, vertex_text=name, edge_color=intersection_map)
 
-    def draw_spanning(self, multigoal=[], verbose=False):
+    def draw_spanning(self, multigoal=[], verbose=False, cache=None):
         """
         Draw the graph generated by the spanning function.
 
         :param multigoal: list of vertex labels as strings. Correspond to 'name' vertex property.
+        :param cache: an optional util.algo.AnalysisCache memoizing the spanning
         :return:
         """
         if not multigoal:
@@ -125,14 +92,17 @@ class RubikLoader(BasicLoader):
         else:
             multigoal = [self.index[x] for x in multigoal]
 
-        span_map = spanning(self.g, multigoal, verbose)
+        if cache is not None:
+            span_map = cache.call(spanning, self.g, multigoal, verbose=verbose)
+        else:
+            span_map = spanning(self.g, multigoal, verbose)
 
-        move = self.g.edge_properties['move']
-        name = self.g.vertex_properties['name']
-        self.g.set_edge_filter(span_map)
-        pos = sfdp_layout(self.g, gamma=1.5)
+        gv = GraphView(self.g, efilt=span_map)
+        move = self.moves.labels(gv.edge_properties['move'])
+        name = gv.vertex_properties['name']
+        pos = sfdp_layout(gv, gamma=1.5)
 
-        graph_draw(self.g, pos, output_size=(1000, 1000),
+        graph_draw(gv, pos, output_size=(1000, 1000),
                    edge_text=move, vertex_text=name, edge_text_size=8)
 
 
@@ -187,7 +157,8 @@ if __name__ == '__main__':
     # ldr.g.load('data/MRubikg.xml.gz')
     ldr.load_matrix('data/MiniRubik.txt')
     print ldr.g
-    split_check(ldr.g, [ldr.index['ABCD'], ldr.index['ABDC']])
+    cache = AnalysisCache()
+    cache.call(split_check, ldr.g, [ldr.index['ABCD'], ldr.index['ABDC']])
     ldr.draw()
 
-    ldr.draw_spanning(multigoal=['ABCD', 'ABDC'])
+    ldr.draw_spanning(multigoal=['ABCD', 'ABDC'], cache=cache)
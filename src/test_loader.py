@@ -0,0 +1,26 @@
+import unittest
+from loader import tokenize_matrix_line
+
+__author__ = 'Gian Paolo Jesi'
+
+"""
+Tests of the matrix line tokenizer of the loaders.
+"""
+
+
+class TokenizeMatrixLineTest(unittest.TestCase):
+    def test_card_line(self):
+        line = '{{"3H", "4C", "Ck"}, {"2H", "4C", "Nk"}, "U"}\n'
+        self.assertEqual(tokenize_matrix_line(line), [('3H', '4C', 'Ck'), ('2H', '4C', 'Nk'), 'U'])
+
+    def test_name_line(self):
+        self.assertEqual(tokenize_matrix_line('{"ABCD", \'ABDC\', "D"}'), ['ABCD', 'ABDC', 'D'])
+
+    def test_malformed_lines(self):
+        for line in ('{"ABCD", ABDC, "D"}', '{"ABCD" "ABDC", "D"}', '{"ABCD", "ABDC", "D",}',
+                     '{{"3H", 4}, {"2H"}, "U"}', '{{"3H"}, {"2H", "U"}', '"ABCD", "ABDC", "D"'):
+            self.assertRaises(ValueError, tokenize_matrix_line, line)
+
+
+if __name__ == '__main__':
+    unittest.main()
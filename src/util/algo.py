@@ -3,122 +3,262 @@ __author__ = 'Gian Paolo Jesi'
 from graph_tool import Graph, GraphView
 from graph_tool.topology import shortest_distance
 from itertools import combinations
-from collection import make_toy_graph
 from graph_tool.draw import *
 from graph_tool.util import find_vertex
 from math import factorial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from hashlib import sha1
+from json import dumps, load
+from os import makedirs, rename, fdopen, remove
+from os.path import exists, isdir, join
+from tempfile import mkstemp
+from collections import OrderedDict
+from bfs import csr, gather, bfs_levels, reverse_bfs
+import cPickle as pickle
 import numpy as np
 
 
-def spanning_tree(g, multigoal=[], verbose=False):
+def edge_arrays(g):
     """
-    Generate a spanning tree for the given graph g.
+    Get the edges of a graph as NumPy arrays, honouring its filters.
 
     :param g: Graph based object
-    :param multigoal: list of goal vertexes (where the spanning starts)
-    :param verbose: default disabled
-    :return: an boolean edge property map, marking the edges of the spanning tree
+    :return: a triplet of arrays (source, target, edge index)
     """
-    assert len(multigoal) != 0
+    try:
+        edges = g.get_edges([g.edge_index])
+    except TypeError:  # older graph_tool releases always return the edge index
+        edges = g.get_edges()
 
-    gv = g.copy()
-    stree = gv.new_edge_property('bool')
-    actual = multigoal
+    return edges[:, 0], edges[:, 1], edges[:, 2]
 
-    while len(actual) != 0:
-        # kills outgoing edges from current actual nodes
-        temp = [item for item in gv.edges() if item.source() in actual]
-        for e in temp:
-            gv.remove_edge(e)
 
-        predecessors = [item for item in gv.edges() if item.target() in actual]
-        # EXPERIMENTAL! Keeps just one edge having the same source
-        seen = set()
-        keep = []
-        for item in predecessors:
-            if item.source() in seen:
-                pass  # discard
-            else:
-                seen.add(item.source())
-                keep.append(item)
+def _spanning_edges(g, multigoal, verbose, efilt=None):
+    """
+    Mark the edges (u, v) where v is one level closer to the goals than u.
+
+    :return: a triplet (source, edge index, mark) of arrays, in edge iteration order
+    """
+    source, target, index = edge_arrays(g)
+    if efilt is not None:
+        keep = np.asarray(getattr(efilt, 'a', efilt), dtype=bool)[index]
+        source, target, index = source[keep], target[keep], index[keep]
+    level = reverse_bfs(source, target, g.num_vertices(ignore_filter=True),
+                        [int(v) for v in multigoal])
+    if verbose:
+        print "levels: ", level
 
-        predecessors = keep
+    mark = (level[target] >= 0) & (level[source] == level[target] + 1)
+    return source, index, mark
 
-        # attaches the predecessor to the spanning tree:
-        for e in predecessors:
-            stree[e] = 1
 
-        actual = frozenset([e.source() for e in predecessors])
+def spanning_tree(g, multigoal=[], verbose=False, efilt=None):
+    """
+    Generate a spanning tree for the given graph g. Among the edges of the spanning, just the first
+    one leaving each vertex is kept.
+
+    :param g: Graph based object
+    :param multigoal: list of goal vertexes (where the spanning starts)
+    :param verbose: default disabled
+    :param efilt: optional boolean edge property map (or array indexed by edge index) restricting
+        the edges to use, as an edge filter would, without making a filtered view of the graph
+    :return: an boolean edge property map, marking the edges of the spanning tree
+    """
+    assert len(multigoal) != 0
+
+    source, index, mark = _spanning_edges(g, multigoal, verbose, efilt)
+    marked = np.nonzero(mark)[0]
+    first = np.unique(source[marked], return_index=True)[1]
 
+    stree = g.new_edge_property('bool')
+    stree.a[index[marked[first]]] = True
     return stree
 
 
-def spanning(g, multigoal=[], verbose=False):
+def spanning(g, multigoal=[], verbose=False, efilt=None):
     """
     Generate a spanning for the given graph g.
     Multiple starting nodes can be expressed in the multigoal parameter list.
+    The spanning holds the edges leading each vertex one step closer to its nearest goal: it is
+    computed by a single breadth-first search over the reversed edges, without copying the graph.
 
     :param g: Graph based object
     :param multigoal: list of goal vertexes (where the spanning starts)
     :param verbose: default disabled
+    :param efilt: optional boolean edge property map (or array indexed by edge index) restricting
+        the edges to use, as an edge filter would, without making a filtered view of the graph
     :return: an boolean edge property map, marking the edges of the spanning
     """
     assert len(multigoal) != 0
 
-    gv = g.copy()
+    source, index, mark = _spanning_edges(g, multigoal, verbose, efilt)
 
-    gv.set_fast_edge_removal()  # a bit faster
-    spanning_g = gv.new_edge_property('bool')
-    actual = multigoal
+    spanning_g = g.new_edge_property('bool')
+    spanning_g.a[index[mark]] = True
+    return spanning_g
 
-    while len(actual) != 0:
-        temp = [item for item in gv.edges() if item.source() in actual]
-        for e in temp:
-            if verbose:
-                print("removing: ", e)
-            gv.remove_edge(e)
 
-        predecessors = [item for item in gv.edges() if item.target() in actual]
-        if verbose:
-            print "pred: ", predecessors
+def terminal_states(g, target=None, value=None):
+    """
+    Mark the terminal states: the vertexes without out edges and, when a vertex property is given,
+    the ones where it holds the value (e.g. 2H in the 'target' card property of the loaders).
+
+    :param g: Graph based object
+    :param target: optional vertex property map with numeric values, such as the uint8 codes of
+        loader.Vocabulary
+    :param value: the value (code) marking a terminal state in target
+    :return: a boolean vertex property map
+    """
+    vertices = g.get_vertices()
+    terminal = g.get_out_degrees(vertices) == 0
+    if target is not None and value is not None:
+        terminal |= target.a[vertices] == value
 
-        # attaches the predecessor to the spanning:
-        for e in predecessors:
-            spanning_g[e] = 1
+    leaf = g.new_vertex_property('bool')
+    leaf.a[vertices] = terminal
+    return leaf
+
+
+def goal_distances(g, goals, workers=None, compact=False):
+    """
+    Distances from every vertex to each goal, one breadth-first search per goal over the reversed
+    graph. It matches the goal rows of the transposed all-pairs distance matrix.
+
+    :param g: graph
+    :param goals: list of vertexes (goals)
+    :param workers: number of threads running the searches. Default: serial
+    :param compact: store the rows with the smallest sufficient unsigned dtype, see
+        compact_distances
+    :return: a (len(goals), V) NumPy array; unreachable vertexes get the shortest_distance
+    sentinel value, or the dtype maximum when compact
+    """
+    rg = GraphView(g, reversed=True)
 
-        actual = frozenset([e.source() for e in predecessors])
+    def row(goal):
+        return shortest_distance(rg, source=goal).a
+
+    if workers and workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            rows = pool.map(row, goals)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rows = [row(goal) for goal in goals]
+
+    if compact:
+        return compact_distances(rows)
+
+    return np.array(rows)
+
+
+def _goal_rows(g, goals, full_matrix=False, workers=None, distances=None, compact=False):
+    """
+    Distances from every vertex to each goal, as a (len(goals), V) array, see split_check.
+    """
+    if distances is not None:
+        return np.array([distances.to_goal(g.vertex_index[goal], compact) for goal in goals])
+
+    if full_matrix:
+        distances = shortest_distance(g)
+        mat = np.array([distances[v].a for v in g.vertices()])
+        mat = mat.T
+        goal_rows = mat[[g.vertex_index[goal] for goal in goals]]
+        return compact_distances(goal_rows) if compact else goal_rows
+
+    return goal_distances(g, goals, workers, compact)
+
+
+def goal_basins(g, goals=[], verbose=False):
+    """
+    Partition the vertexes into the basins of the goals: each vertex is labeled with its nearest
+    goal by a single multi-source breadth-first search over the reversed edges, carrying the goal
+    labels along. Linear in vertices plus edges, unlike the pairwise comparison of the goal rows.
+
+    :param g: graph
+    :param goals: list of vertexes (goals)
+    :param verbose: default disabled
+    :return: a triplet (nearest_goal, distance, tie) of arrays indexed by vertex: the position in
+    goals of the nearest goal (the first one on ties), the distance to it and whether other goals
+    are at the same distance. Vertexes that cannot reach any goal get -1 as goal and distance.
+    """
+    assert len(goals) != 0
+
+    n = g.num_vertices(ignore_filter=True)
+    source, target, index = edge_arrays(g)
+    if not g.is_directed():
+        source, target = np.concatenate((source, target)), np.concatenate((target, source))
+    order, offsets = csr(target, n)
+
+    distance = np.full(n, -1, dtype=np.int64)
+    nearest = np.full(n, len(goals), dtype=np.int64)
+    farthest = np.full(n, -1, dtype=np.int64)  # largest goal label reaching a vertex
+    frontier = np.array([int(goal) for goal in goals], dtype=np.int64)
+    labels = np.arange(len(goals))
+
+    depth = 0
+    while len(frontier):
+        np.minimum.at(nearest, frontier, labels)
+        np.maximum.at(farthest, frontier, labels)
+        frontier = np.unique(frontier)
+        distance[frontier] = depth
         if verbose:
-            print "actual: ", actual
+            print "level %d: %d vertexes" % (depth, len(frontier))
 
-    return spanning_g
+        # the new vertexes inherit both the smallest and the largest label of their successors:
+        positions = gather(order, offsets, frontier)
+        candidates = source[positions]
+        new = distance[candidates] < 0
+        successors = target[positions[new]]
+        frontier = np.concatenate((candidates[new], candidates[new]))
+        labels = np.concatenate((nearest[successors], farthest[successors]))
+        depth += 1
+
+    reached = distance >= 0
+    tie = reached & (nearest != farthest)
+    nearest[~reached] = -1
+    return nearest, distance, tie
 
 
-def split_check(g, goals=[], verbose=False):
+def split_check(g, goals=[], verbose=False, full_matrix=False, workers=None, distances=None,
+                compact=False):
     """
     Check if the graph can be split according to the given vertexes in the goal list.
-    Based on shortest distance matrix.
+    Based on the distances to the goals: just one row for each goal is computed, unless the full
+    all-pairs distance matrix is explicitly requested.
 
     :param g: graph
     :param goals: list of vertexes (goals)
     :param verbose: default disabled
+    :param full_matrix: compute the whole shortest distance matrix, as in the early versions
+    :param workers: number of threads computing the goal rows, see goal_distances
+    :param distances: a DistanceMatrix of the graph to read the distances from, see
+        distance_matrix
+    :param compact: keep the distances in the smallest sufficient unsigned dtype and the
+        differences in the matching signed one (int16 for uint8 distances). An unreachable
+        vertex differs from any reachable one, as in the default mode, but by a different amount.
     :return: a pair: (bool, NumPy Array) where the bool represents if we have any split in the graph
     and the string is the distance differences for every combination of goals.
     """
     assert len(goals) >= 2
 
     any_split = False
-    distances = shortest_distance(g)
-
-    mat = np.array([distances[v].a for v in g.vertices()])
-    mat = mat.T
+    goal_rows = _goal_rows(g, goals, full_matrix, workers, distances, compact)
 
     ng = len(goals)
     rows = factorial(ng) / 2 / factorial(ng - 2)
-    result = np.zeros(shape=(rows, g.num_vertices()))
+    if compact:
+        diff_type = difference_dtype(goal_rows[0].dtype)
+        result = np.zeros(shape=(rows, g.num_vertices()), dtype=diff_type)
+        goal_rows = [item.astype(diff_type) for item in goal_rows]
+    else:
+        result = np.zeros(shape=(rows, g.num_vertices()))
 
     index = 0
-    for subset in combinations(goals, 2):
-        row = mat[g.vertex_index[subset[0]]] - mat[g.vertex_index[subset[1]]]
+    for a, b in combinations(range(ng), 2):
+        row = goal_rows[a] - goal_rows[b]
         if verbose:
             print row
 
@@ -133,7 +273,47 @@ def split_check(g, goals=[], verbose=False):
     return any_split, result
 
 
-def even_odd(g, goals=[], letters=False, verbose=False):
+def split_report(g, goals=[], workers=None, distances=None, block=None):
+    """
+    Pairwise split analysis of many goals. The goal rows are compared in blocks of pairs with a
+    single broadcast each: the upper triangle of the k x k x V comparison is streamed one goal at
+    a time, so that memory stays proportional to k x V.
+
+    :param g: graph
+    :param goals: list of vertexes (goals)
+    :param workers: number of threads computing the goal rows, see goal_distances
+    :param distances: a DistanceMatrix of the graph to read the distances from, see
+        distance_matrix
+    :param block: number of goals compared at once against each goal. Default: all of them
+    :return: a tuple (pairs, split, ties, tied): pairs is a (P, 2) array of goal positions in the
+    order of combinations(goals, 2), split a bool array telling if each pair splits the graph (no
+    vertex at the same distance from both goals), ties the number of vertexes at the same
+    distance and tied a list with the array of their indexes, for each pair
+    """
+    assert len(goals) >= 2
+
+    goal_rows = _goal_rows(g, goals, workers=workers, distances=distances, compact=True)
+    ng = len(goals)
+    if block is None:
+        block = ng
+
+    pairs, ties, tied = [], [], []
+    for a in range(ng - 1):
+        for start in range(a + 1, ng, block):
+            others = np.arange(start, min(start + block, ng))
+            equal = goal_rows[others] == goal_rows[a]
+            counts = np.count_nonzero(equal, axis=1)
+            pairs.extend([(a, b) for b in others])
+            ties.append(counts)
+            rows, cols = np.nonzero(equal)
+            tied.extend(np.split(cols, np.cumsum(counts)[:-1]))
+
+    ties = np.concatenate(ties)
+    return np.array(pairs, dtype=np.int64), ties == 0, ties, tied
+
+
+def even_odd(g, goals=[], letters=False, verbose=False, goal_rows=False, distances=None,
+             compact=False):
     """
     Generate the even/odd matrix. Essentially, it calculates the distance matrix and converts it
     into a 0/1 matrix just keeping the information about even (1) or odd (0) distances.
@@ -142,43 +322,416 @@ def even_odd(g, goals=[], letters=False, verbose=False):
     :param goals: list of vertexes (goals)
     :param letters: whether or not using letters ('E', 'O') into even-odd matrix. Default False.
     :param verbose: default disabled
-    :return:
+    :param goal_rows: compute just the rows of the goals (distances from each goal) instead of
+        the whole V x V matrix. Default False.
+    :param distances: a DistanceMatrix of the graph to read the distances from, see
+        distance_matrix
+    :param compact: hold the computed distances in the smallest unsigned dtype fitting the graph
+        instead of the shortest_distance ones, see compact_dtype
+    :return: a pair (eo, eo_new) of uint8 matrices (or char matrices with letters): eo_new has the
+    goals first, both as rows and columns (as columns only with goal_rows)
     """
     assert len(goals) >= 2
 
-    distances = shortest_distance(g)
-    eo = np.zeros(shape=(g.num_vertices(), g.num_vertices()))
-    eo = eo.T
-    for v in g.vertices():
-        print distances[v].a
-
-    index = 0
-    for v in g.vertices():
-        j = 0
-        for value in distances[v].a:
-            # print value
-            if letters:
-                eo[index][j] = 'E' if value % 2 == 0 else 'O'
-            else:
-                eo[index][j] = 1.0 if value % 2 == 0 else 0.0
-            j += 1
+    # the unreachable sentinels are all odd, whatever the distance dtype
+    if distances is not None:
+        if goal_rows:
+            dist = distances.matrix[[g.vertex_index[goal] for goal in goals]]
+        else:
+            dist = distances.matrix
+    elif goal_rows:
+        dist = np.array([shortest_distance(g, source=goal).a for goal in goals])
+        if compact:
+            dist = compact_distances(dist)
+    elif compact:
+        distances = shortest_distance(g)
+        n = g.num_vertices()
+        dist = np.empty((n, n), dtype=compact_dtype(n))
+        for i, v in enumerate(g.vertices()):
+            dist[i] = compact_distances(distances[v].a, dist.dtype)
+    else:
+        distances = shortest_distance(g)
+        dist = np.array([distances[v].a for v in g.vertices()])
+    if verbose:
+        print dist
 
-        index += 1
+    eo = ((dist & 1) == 0).astype(np.uint8)
 
     # transforming even-odd
-    new_order = []
-    for item in goals:
-        new_order.append(g.vertex_index[item])
-    for item in [x for x in g.vertices() if x not in goals]:
-        new_order.append(g.vertex_index[item])
+    goal_index = [g.vertex_index[item] for item in goals]
+    others = np.ones(eo.shape[1], dtype=bool)
+    others[goal_index] = False
+    new_order = np.concatenate((goal_index, np.nonzero(others)[0]))
     if verbose:
         print "Reordering EO-matrix as follows: %s" % new_order
 
-    eo_new = eo[:, new_order][new_order]
+    if goal_rows:
+        eo_new = eo[:, new_order]
+    else:
+        eo_new = eo[np.ix_(new_order, new_order)]
+
+    if letters:
+        eo = np.where(eo, 'E', 'O')
+        eo_new = np.where(eo_new, 'E', 'O')
+
     return eo, eo_new
 
 
+_UNREACHABLE = np.iinfo(np.int32).max  # shortest_distance value for unreachable vertexes
+
+
+def compact_dtype(n):
+    """
+    Smallest unsigned integer type holding the distances of a graph with n vertexes, keeping its
+    maximum value free as the unreachable sentinel.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n - 1 < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+    return np.dtype(np.uint64)
+
+
+def compact_distances(dist, dtype=None):
+    """
+    Convert shortest_distance results to a compact unsigned dtype. The maximum value of the dtype
+    is the unreachable sentinel.
+
+    :param dist: an array (or a list of rows) of distances, unreachable ones marked by the
+        shortest_distance sentinel value
+    :param dtype: the target dtype. Default: the smallest one fitting the largest distance
+    :return: a NumPy array of the given dtype
+    """
+    dist = np.asarray(dist)
+    unreachable = dist == _UNREACHABLE
+    if dtype is None:
+        top = dist[~unreachable].max() if dist.size > unreachable.sum() else 0
+        dtype = compact_dtype(int(top) + 1)
+
+    compact = dist.astype(dtype)
+    compact[unreachable] = np.iinfo(dtype).max
+    return compact
+
+
+def difference_dtype(dtype):
+    """
+    Signed dtype holding the differences of two distances of the given unsigned dtype, sentinel
+    included: int16 for uint8 distances.
+    """
+    return np.dtype({1: np.int16, 2: np.int32}.get(np.dtype(dtype).itemsize, np.int64))
+
+
+def graph_fingerprint(g):
+    """
+    Cheap structural fingerprint of a graph: vertex and edge counts plus a hash of the edge arrays.
+    """
+    source, target, index = edge_arrays(g)
+    h = sha1()
+    h.update(np.ascontiguousarray(source, dtype=np.int64).tostring())
+    h.update(np.ascontiguousarray(target, dtype=np.int64).tostring())
+    return '%d-%d-%d-%s' % (g.num_vertices(), g.num_edges(), g.is_directed(), h.hexdigest())
+
+
+class DistanceMatrix(object):
+    """
+    All-pairs distance matrix stored on disk as a np.memmap: row v holds the distances from v, as
+    a row of shortest_distance(g) does. Rows already computed are marked in a side file, so that
+    an interrupted build can be resumed.
+    """
+
+    def __init__(self, filename, n, dtype, fingerprint):
+        self.filename = filename
+        self.n = n
+        self.dtype = np.dtype(dtype)
+        self.unreachable = np.iinfo(self.dtype).max
+        self.fingerprint = fingerprint
+
+        meta = {'n': n, 'dtype': self.dtype.str, 'fingerprint': fingerprint}
+        resume = False
+        if exists(filename + '.json') and exists(filename) and exists(filename + '.done'):
+            with open(filename + '.json') as f:
+                resume = load(f) == meta
+
+        mode = 'r+' if resume else 'w+'
+        self.matrix = np.memmap(filename, dtype=self.dtype, mode=mode, shape=(n, n))
+        self.done = np.memmap(filename + '.done', dtype=np.uint8, mode=mode, shape=(n,))
+        if not resume:
+            with open(filename + '.json', 'w') as f:
+                f.write(dumps(meta))
+
+    def complete(self):
+        return bool(self.done.all())
+
+    def to_goal(self, goal, compact=False):
+        """
+        Distances from every vertex to the goal (a column of the matrix), with the unreachable
+        sentinel of shortest_distance so that they mix with its results. When compact they are
+        returned as stored, with the dtype maximum as the sentinel.
+        """
+        if compact:
+            return np.array(self.matrix[:, goal])
+
+        col = np.array(self.matrix[:, goal], dtype=np.int64)
+        col[col == self.unreachable] = _UNREACHABLE
+        return col
+
+    def from_vertex(self, v, compact=False):
+        """
+        Distances from the vertex to every other one (a row of the matrix), with the unreachable
+        sentinel of shortest_distance, or as stored when compact.
+        """
+        if compact:
+            return np.array(self.matrix[v])
+
+        row = np.array(self.matrix[v], dtype=np.int64)
+        row[row == self.unreachable] = _UNREACHABLE
+        return row
+
+
+_worker_rows = None  # (ends, order, offsets, matrix) of the worker processes
+
+
+def _init_rows_worker(source, target, n, filename, dtype):
+    global _worker_rows
+    order, offsets = csr(source, n)
+    matrix = np.memmap(filename, dtype=dtype, mode='r+', shape=(n, n))
+    _worker_rows = (target, order, offsets, matrix)
+
+
+def _compute_rows(rows):
+    """
+    Compute a block of distance rows in a worker process and write them into the matrix file.
+    """
+    ends, order, offsets, matrix = _worker_rows
+    n = len(offsets) - 1
+    sentinel = np.iinfo(matrix.dtype).max
+    for v in rows:
+        level = bfs_levels(ends, order, offsets, n, [v])
+        level[level < 0] = sentinel
+        matrix[v] = level
+
+    matrix.flush()
+    return rows
+
+
+def distance_matrix(g, filename, workers=None, block=256, progress=None):
+    """
+    Build the all-pairs distance matrix of a graph into a disk-backed np.memmap, computing the
+    breadth-first rows in worker processes. Calling it again on the same file resumes an
+    interrupted build; a file built for a different graph is overwritten.
+
+    :param g: graph
+    :param filename: the matrix file; filename.done and filename.json are written along
+    :param workers: number of worker processes. Default: one for each CPU
+    :param block: number of rows computed by a worker at a time
+    :param progress: optional callable receiving (rows done, total rows) after each block
+    :return: a DistanceMatrix; its matrix uses the smallest sufficient unsigned dtype, see
+    compact_dtype
+    """
+    n = g.num_vertices(ignore_filter=True)
+    source, target, index = edge_arrays(g)
+    if not g.is_directed():
+        source, target = np.concatenate((source, target)), np.concatenate((target, source))
+
+    dm = DistanceMatrix(filename, n, compact_dtype(n), graph_fingerprint(g))
+    pending = np.nonzero(dm.done == 0)[0]
+    blocks = [pending[i:i + block] for i in range(0, len(pending), block)]
+    count = n - len(pending)
+    if progress:
+        progress(count, n)
+
+    if blocks:
+        pool = Pool(workers, initializer=_init_rows_worker,
+                    initargs=(source, target, n, filename, dm.dtype))
+        try:
+            for rows in pool.imap_unordered(_compute_rows, blocks):
+                dm.done[rows] = 1
+                dm.done.flush()
+                count += len(rows)
+                if progress:
+                    progress(count, n)
+        finally:
+            pool.close()
+            pool.join()
+
+    return dm
+
+
+def _option_key(value):
+    """
+    Hashable, session independent key of an option value, see AnalysisCache.key.
+    """
+    if isinstance(value, DistanceMatrix):
+        return ('distances', value.filename, value.dtype.str, value.fingerprint, value.complete())
+    if hasattr(value, 'key_type'):  # a property map
+        value = np.asarray(value.a)
+    if isinstance(value, np.ndarray):
+        return ('array', value.dtype.str, value.shape,
+                sha1(np.ascontiguousarray(value).tostring()).hexdigest())
+    if isinstance(value, (tuple, list)):
+        return tuple([_option_key(item) for item in value])
+
+    hash(value)  # unhashable options are rejected here
+    return value
+
+
+def _nbytes(value):
+    """
+    Approximate memory size of a cached analysis result.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum([_nbytes(item) for item in value]) + 8 * len(value)
+    if isinstance(value, _StoredProperty):
+        return value.array.nbytes
+    return 64
+
+
+class _StoredProperty(object):
+    """
+    Values of a vertex or edge property map, detached from its graph.
+    """
+
+    def __init__(self, prop):
+        self.key_type = prop.key_type()
+        self.value_type = prop.value_type()
+        self.array = np.array(prop.a)
+
+    def restore(self, g):
+        if self.key_type == 'e':
+            prop = g.new_edge_property(self.value_type)
+        else:
+            prop = g.new_vertex_property(self.value_type)
+        prop.a[:] = self.array
+        return prop
+
+
+class AnalysisCache(object):
+    """
+    Memoizes the analysis functions of this module (split_check, even_odd, spanning, ...) by
+    graph fingerprint, goal tuple and options. The results are kept in memory up to max_bytes,
+    evicting the least recently used ones, and optionally pickled into a directory as a second
+    tier surviving the session. Property maps are stored as arrays and rebuilt on the graph at
+    each hit. Cached arrays are shared: callers must not modify them.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def key(self, func, g, goals, options):
+        """
+        Key of a call: arrays and property maps among the options are keyed by content and
+        distance matrices by their file and fingerprint, so that keys are stable across sessions.
+        """
+        options = dict(options)
+        options.pop('verbose', None)
+        return (func.__name__, graph_fingerprint(g), tuple([int(v) for v in goals]),
+                tuple(sorted([(name, _option_key(value)) for name, value in options.items()])))
+
+    def _path(self, key):
+        return join(self.directory, sha1(repr(key)).hexdigest() + '.pkl')
+
+    def get(self, key):
+        """
+        :return: the stored value, or None on a miss
+        """
+        if key in self.entries:
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+        if self.directory is not None and exists(self._path(key)):
+            try:
+                with open(self._path(key), 'rb') as f:
+                    stored_key, value = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError) as e:
+                print "Warning: discarding broken cache entry %s: %s" % (self._path(key), e)
+                return None
+            if stored_key == key:
+                self._remember(key, value)
+                return value
+
+        return None
+
+    def put(self, key, value):
+        """
+        Store a value in memory and, when a directory is set, on disk. Each writer pickles into
+        its own temporary file renamed over the entry, so that concurrent writers of a key just
+        replace each other's identical entry. Errors writing the disk tier (e.g. an unwritable
+        directory) are reported as a warning and ignored.
+        """
+        self._remember(key, value)
+        if self.directory is None:
+            return
+
+        temp = None
+        try:
+            if not isdir(self.directory):
+                try:
+                    makedirs(self.directory)
+                except OSError:
+                    if not isdir(self.directory):  # not created by a concurrent writer
+                        raise
+            fd, temp = mkstemp(suffix='.tmp', dir=self.directory)
+            with fdopen(fd, 'wb') as f:
+                pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+            rename(temp, self._path(key))
+            temp = None
+        except EnvironmentError as e:  # IOError, or OSError from makedirs and rename
+            print "Warning: cannot write the analysis cache %s: %s" % (self._path(key), e)
+        finally:
+            if temp is not None and exists(temp):
+                remove(temp)
+
+    def _remember(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.size -= _nbytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.max_bytes:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.size -= _nbytes(old_value)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def call(self, func, g, goals, **options):
+        """
+        Call func(g, goals, **options), or return its memoized result. The options must be
+        hashable; verbose is not part of the key.
+
+        :param func: an analysis function of this module, taking the graph and the goal list
+        :param g: graph
+        :param goals: list of vertexes (goals)
+        :return: the result of func
+        """
+        key = self.key(func, g, goals, options)
+        value = self.get(key)
+        if value is None:
+            value = func(g, goals, **options)
+            if hasattr(value, 'key_type'):  # a property map: keep just its values
+                value = _StoredProperty(value)
+            self.put(key, value)
+
+        if isinstance(value, _StoredProperty):
+            return value.restore(g)
+
+        return value
+
+
 if __name__ == '__main__':
+    # imported here: util.collection needs networkx, which the analysis functions do not
+    from collection import make_toy_graph
+
     as_undir_tuples = [('a', 'b'), ('a', 'c'), ('a', 'd'), ('b', 'd'), ('c', 'g'),
                        ('d', 'f'), ('d', 'g'), ('e', 'b'), ('e', 'd'), ('f', 'c'),
                        ('g', 'e')]
@@ -190,6 +743,7 @@ if __name__ == '__main__':
 
     print split_check(gr, goals, verbose=True)
     print even_odd(gr, goals, verbose=True)
+    print goal_basins(gr, goals)
 
     emap = spanning(gr, goals, verbose=False)
     u = GraphView(gr, efilt=emap)
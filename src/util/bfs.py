@@ -0,0 +1,85 @@
+import numpy as np
+
+__author__ = 'Gian Paolo Jesi'
+
+"""
+Breadth-first search over graphs given as NumPy edge arrays (source, target), with no graph_tool
+dependency. The edges are grouped by vertex in a compressed sparse row layout and every level is
+expanded at once; all the searches are linear in vertices plus edges.
+"""
+
+
+def csr(keys, n):
+    """
+    Group the edge positions by key (a vertex index), like an adjacency list.
+
+    :return: a pair (order, offsets): the positions of the edges with key v are
+    order[offsets[v]:offsets[v + 1]]
+    """
+    order = np.argsort(keys, kind='mergesort')
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=offsets[1:])
+    return order, offsets
+
+
+def gather(order, offsets, vertices):
+    """
+    Positions of all the edges grouped under the given vertices, see csr.
+    """
+    starts = offsets[vertices]
+    lengths = offsets[vertices + 1] - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return order[shift + np.arange(total)]
+
+
+def bfs_levels(ends, order, offsets, n, sources):
+    """
+    Breadth-first levels from the sources, following the edges grouped by csr and moving to
+    their other ends.
+    """
+    level = np.full(n, -1, dtype=np.int64)
+    frontier = np.unique(np.asarray(sources, dtype=np.int64))
+    level[frontier] = 0
+
+    depth = 0
+    while len(frontier):
+        candidates = ends[gather(order, offsets, frontier)]
+        frontier = np.unique(candidates[level[candidates] < 0])
+        depth += 1
+        level[frontier] = depth
+
+    return level
+
+
+def forward_bfs(source, target, n, sources):
+    """
+    Multi-source breadth-first search along the edges: the level of a vertex is the number of
+    edges of its shortest path from any of the sources.
+
+    :param source: edge source array
+    :param target: edge target array
+    :param n: number of vertexes (the largest vertex index plus one)
+    :param sources: indexes of the source vertexes
+    :return: an int array with the level of each vertex, -1 when no source reaches it
+    """
+    order, offsets = csr(source, n)
+    return bfs_levels(target, order, offsets, n, sources)
+
+
+def reverse_bfs(source, target, n, sources):
+    """
+    Multi-source breadth-first search over the reversed edges: the level of a vertex is the
+    number of edges of its shortest path to any of the sources.
+
+    :param source: edge source array
+    :param target: edge target array
+    :param n: number of vertexes (the largest vertex index plus one)
+    :param sources: indexes of the source vertexes
+    :return: an int array with the level of each vertex, -1 when it cannot reach any source
+    """
+    order, offsets = csr(target, n)
+    return bfs_levels(source, order, offsets, n, sources)
@@ -1,8 +1,10 @@
+# -*- coding: utf-8 -*-
 from collections import deque
-from itertools import permutations
+from heapq import heappush, heappop
+from itertools import permutations, product, islice
+from multiprocessing import Pool
+import numpy as np
 # from json import dumps
-from copy import deepcopy
-from sys import maxsize
 
 __author__ = 'Gian Paolo Jesi'
 
@@ -77,245 +79,530 @@ g_struct = {
 }
 
 
-def _process_lambda(rule, state):
-    f = eval(rule)
-    new_state = f(*state)
-    return new_state
+class StateCodec(object):
+    """
+    Compact representation of the game states. Every value a position can take (cards and extra
+    feature values like the PL ones) gets a small integer code, so that a state is a plain tuple of
+    ints following the 'status_keys' order. The features of each value are kept in a side table
+    shared by all the states.
+    """
 
+    def __init__(self, game_struct):
+        self.status_keys = list(game_struct['status_keys'])
+        elements = game_struct['elements']
+
+        # standard values first, then the domains of the extra features:
+        values = sorted([k for k in elements.keys() if k not in self.status_keys])
+        for key in self.status_keys:
+            for value in elements.get(key, {}).get('values', []):
+                if value not in values:
+                    values.append(value)
+
+        self.values = values
+        self.code = dict((v, i) for i, v in enumerate(values))
+
+        # read only enriched elements, one for each code:
+        self.elements = []
+        for i, value in enumerate(values):
+            elem = dict(elements.get(value, {}))
+            elem['value'] = value
+            elem['code'] = i
+            self.elements.append(elem)
+
+    def encode(self, state):
+        """
+        Encode a state given as a list of key/value dictionaries (see 'st') or as a sequence of
+        values following the 'status_keys' order.
+
+        :param state: the state to encode
+        :return: a tuple of ints
+        """
+        values = []
+        for item in state:
+            if isinstance(item, dict):
+                item = item.values()[0]  # dict must have just a single entry k,v
+            values.append(item)
+
+        return tuple([self.code[v] for v in values])
+
+    def decode(self, state):
+        """
+        Decode a state into the tuple of its values.
+        """
+        return tuple([self.values[c] for c in state])
+
+    def label(self, state):
+        """
+        A human readable label for the state: its values separated by blanks.
+        """
+        return ' '.join(self.decode(state))
+
+
+def _compile_lambda(statement, game_struct, codec):
+    """
+    Compile a 'lambda ...' statement once. The resulting step takes the encoded state and returns
+    the new encoded state or None when the rule guard does not hold.
+    """
+    f = eval(statement)
+    elements = codec.elements
 
-def _process_next(rule, state, struct):
-    if state is None:
-        return None
+    def step(state):
+        result = f(*[elements[c] for c in state])
+        if result is None:
+            return None
 
-    result = deepcopy(state)
+        return tuple([elem['code'] for elem in result])
 
-    args = rule.split()
-    # print  "args: ", args
-    for arg in args[1:]:  # from the second string element
-        index = struct['status_keys'].index(arg)
-        var_values = struct['elements'].get(arg, None)
+    return step
+
+
+def _compile_next(statement, game_struct, codec):
+    """
+    Compile a 'next KEY [KEY ...]' statement. Each KEY position is moved to the value following the
+    current one in the domain listed by the corresponding 'elements' entry.
+    """
+    rotations = []
+    for arg in statement.split()[1:]:  # from the second string element
+        index = game_struct['status_keys'].index(arg)
+        var_values = game_struct['elements'].get(arg, None)
         if var_values is None:
             print "Warning: position %s has no corresponding entry in 'elements' " \
                   "structure." % arg
         else:
-            next_value = deque(struct['elements'][arg]['values'])
+            next_value = deque(var_values['values'])
             next_value.rotate(-1)
-            result[index]['value'] = next_value[0]
-            # print "set to: ", next_value[0]
+            successor = range(len(codec.values))
+            for value, nxt in zip(var_values['values'], next_value):
+                successor[codec.code[value]] = codec.code[nxt]
+            rotations.append((index, tuple(successor)))
+
+    def step(state):
+        if state is None:
+            return None
+
+        result = list(state)
+        for index, successor in rotations:
+            result[index] = successor[result[index]]
+
+        return tuple(result)
 
-    return result
+    return step
 
 
 AVAILABLE_STATEMENTS = {
-    'lambda': _process_lambda,
-    'next': _process_next
+    'lambda': _compile_lambda,
+    'next': _compile_next
 }
 
 
-def _enrich_status(status, game_struct):
+def compile_rules(game_struct, codec=None):
     """
-    Enrich the basic game status with the features listed in the 'elements' section of the
-    game_struct.
+    Compile the 'rules' section of the game structure into a transition program. The rule strings
+    are parsed and evaluated just once: the program can then be applied to any number of states.
 
-    :param status: basic status
     :param game_struct: game structure, a dictionary defining the game in abstract terms.
-    :return:
+    :param codec: the StateCodec of the game structure. A new one is made when missing.
+    :return: a list of pairs (rule_op, steps), one for each rule sequence. Steps is a tuple of
+    callables each mapping an encoded state into the next one (or None when a guard fails).
     """
-    # prepare a list with empty dictionaries:
-    d = []
-    for key_value in status:
-        elem = dict()
-        for k, v in key_value.items():  # earning : dict must have just a single entry k,v
-            elem['value'] = v
-            elem['key'] = k
+    if codec is None:
+        codec = StateCodec(game_struct)
+
+    program = []
+    for rule_op in game_struct['rules']:
+        for rule_seq in game_struct['rules'][rule_op]:
+            steps = []
+            for rule in rule_seq:
+                splt = rule.split()
+                if splt[0] in AVAILABLE_STATEMENTS:
+                    steps.append(AVAILABLE_STATEMENTS[splt[0]](rule, game_struct, codec))
+                else:
+                    print "Waring: unrecognized operation or statement: ", rule
 
-        # enrich with features stated in the game struct:
-        if elem['value'] in game_struct['elements'].keys():
-            for k in game_struct['elements'][elem['value']].keys():
-                elem[k] = game_struct['elements'][elem['value']][k]
+            program.append((rule_op, tuple(steps)))
 
-        d.append(elem)
+    return program
 
-    return d
 
+def _successors(status, program):
+    """
+    Apply a compiled program to a state.
 
-def _evaluate_rules(rule_op, rule_seq, status, game_struct):
-    next_state = None
-    inter_state = deepcopy(status)
-    for rule in rule_seq:
-        splt = rule.split()
-        # print "rule: ", rule
-        if splt[0] in AVAILABLE_STATEMENTS:
-            next_state = AVAILABLE_STATEMENTS[splt[0]](rule, inter_state, game_struct)
+    :param status: the state, in the form expected by the program steps
+    :param program: a compiled program, see compile_rules
+    :return: a generator of pairs (rule_op, next_state) for each rule sequence that applies
+    """
+    for rule_op, steps in program:
+        if not steps:
+            continue
 
+        next_state = status
+        for step in steps:
+            next_state = step(next_state)
             if next_state is None:
-                print "Skip the entire set for rule: ", rule_op
                 break
-            else:
-                # feed the new state as input to the next rule if any:
-                inter_state = deepcopy(next_state)
 
-        else:
-            print "Waring: unrecognized operation or statement: ", rule
+        if next_state is not None:
+            yield rule_op, next_state
+
 
-    return next_state
+def _as_code(state, codec):
+    """
+    Return the encoded form of a state, encoding it when needed.
+    """
+    if isinstance(state, tuple) and state and isinstance(state[0], int):
+        return state
 
+    return codec.encode(state)
 
-def game_states_from2(start_state, game_struct, state_map, edges):
+
+def game_states_from2(start_state, game_struct, state_map, edges, program=None, codec=None):
     """
     Generate the graph/tree of possible game states from a starting one.
 
-    :param start_state: a list of dictionaries key/value of the game state of interest
+    :param start_state: a list of dictionaries key/value of the game state of interest or the
+        state already encoded by the codec
     :param game_struct: a structure defining the game in terms of states, values, rules and
         constraints
-    :param state_map: maps a state value to an index
+    :param state_map: maps an encoded state (see StateCodec) to an index
     :param edges: a list of triplets: (node_a, node_b, op)
-    :return: a pair (dictionary, list) respectively mapping state values to unique index and
+    :param program: the game rules compiled by compile_rules. When missing, the rules are compiled
+        on the fly: callers processing many states should compile them once and pass them along.
+    :param codec: the StateCodec used by the program
+    :return: a pair (dictionary, list) respectively mapping encoded states to unique index and
     listing triplets as (state_i, state_j, rule)
     """
-    status = _enrich_status(start_state, game_struct)
-    # print status
-    # state_map = {}  # maps a state (values) to an index, keeps track of discovered states
-    # edges = []  # maps a state to a pair (state, rule)
+    if codec is None:
+        codec = StateCodec(game_struct)
+    if program is None:
+        program = compile_rules(game_struct, codec)
 
-    state_str = ' '.join([item['value'] for item in status])
-    if state_map.get(state_str, None) is None:
-        state_map[state_str] = len(state_map) + 1  # add the start state
+    status = _as_code(start_state, codec)
+    old_id = state_map.get(status, None)
+    if old_id is None:
+        old_id = state_map[status] = len(state_map) + 1  # add the start state
 
-    for rule_op in game_struct['rules']:
-        # print "Rule operation: ", rule_op
-        for rule_seq in game_struct['rules'][rule_op]:
+    for rule_op, next_state in _successors(status, program):
+        # collect the new state:
+        next_id = state_map.get(next_state, None)
+        if next_id is None:  # when not present, add
+            next_id = state_map[next_state] = len(state_map) + 1
 
-            next_state = None
-            inter_state = deepcopy(status)
-            for rule in rule_seq:
-                splt = rule.split()
-                # print "rule: ", rule
-                if splt[0] in AVAILABLE_STATEMENTS:
-                    next_state = AVAILABLE_STATEMENTS[splt[0]](rule, inter_state, game_struct)
+        edges.append((old_id, next_id, rule_op))
 
-                    if next_state is None:
-                        print "Skip the entire set for rule: ", rule_op
-                        break
-                    else:
-                        # feed the new state as input to the next rule if any:
-                        inter_state = deepcopy(next_state)
+    return state_map, edges
 
-                else:
-                    print "Waring: unrecognized operation or statement: ", rule
 
-            # print "next state: ", next_state
-            if next_state is not None:
-                # collect the new state:
-                s = ' '.join([item['value'] for item in next_state])
-                if state_map.get(s) is None:  # when not present, add
-                    next_state_id = len(state_map.keys()) + 1
-                    state_map[s] = next_state_id
-                    old_s = ' '.join([item['value'] for item in status])
-                    # print "old_s: ", old_s
-                    # print status
-                    edges.append((state_map[old_s], state_map[s], rule_op))
-                    # print "Setting state: %s with id %d and edge: %d, %d, %s" % (s, next_state_id,
-                    #                                                              state_map[
-                    #                                                                  old_s],
-                    #                                                              state_map[s], \
-                    #                                                              rule_op)
-                else:
-                    old_s = ' '.join([item['value'] for item in status])
-                    edges.append((state_map[old_s],
-                                  state_map[s], rule_op))
-                    # print "Setting edge: %d, %d, %s" % (state_map[old_s],
-                    #                                     state_map[s], \
-                    #                                     rule_op)
+def bfs_edges(game_struct, start_state, max_depth=None, max_states=None, depth=None,
+              program=None, codec=None):
+    """
+    Breadth-first exploration of the game states reachable from a starting one. Edges are yielded
+    as soon as they are discovered, so that large games can be streamed into a graph or a file.
 
-    return state_map, edges
+    :param game_struct: a structure defining the game in terms of states, values, rules and
+        constraints
+    :param start_state: a list of dictionaries key/value of the start state or the encoded state
+    :param max_depth: states at this distance from the start are not expanded. Default: no limit
+    :param max_states: maximum number of states to discover. Edges leading to states beyond the
+        budget are dropped. Default: no limit
+    :param depth: optional dictionary filled with the depth of every discovered encoded state.
+        It works as the visited set of the exploration.
+    :param program: the game rules compiled by compile_rules
+    :param codec: the StateCodec used by the program
+    :return: a generator of triplets (src, dst, rule) where src and dst are encoded states
+    """
+    if codec is None:
+        codec = StateCodec(game_struct)
+    if program is None:
+        program = compile_rules(game_struct, codec)
+    if depth is None:
+        depth = dict()
+
+    start = _as_code(start_state, codec)
+    depth[start] = 0
+    frontier = deque([start])
+
+    while frontier:
+        state = frontier.popleft()
+        d = depth[state]
+        if max_depth is not None and d >= max_depth:
+            continue
+
+        for rule_op, next_state in _successors(state, program):
+            if next_state not in depth:
+                if max_states is not None and len(depth) >= max_states:
+                    continue
+                depth[next_state] = d + 1
+                frontier.append(next_state)
+
+            yield state, next_state, rule_op
 
 
 def get_game_graph(start_state, game_struct, state_map, edges, how_many=None):
     """
-    Generate a game graph starting from a specific game state.
+    Generate a game graph starting from a specific game state. States are indexed in breadth-first
+    discovery order.
 
-    :param start_state:
-    :param game_struct:
-    :param state_map: maps a state value to an index
+    :param start_state: a list of dictionaries key/value of the start state or the encoded state
+    :param game_struct: a structure defining the game in terms of states, values, rules and
+        constraints
+    :param state_map: maps an encoded state to an index
     :param edges: a list of triplets: (node_a, node_b, op)
-    :param how_many: howmany states iteration to descend
-    :return:  a pair (dictionary, list) respectively mapping state values to unique index and
+    :param how_many: how many levels to descend from the start state. Default: no limit
+    :return:  a pair (dictionary, list) respectively mapping encoded states to unique index and
     listing triplets as (state_i, state_j, rule)
     """
-    if not how_many:
-        how_many = maxsize
-
-    # state_map = dict()  # maps string state into list of edges
-    print "start state: ", start_state
-    # for x in start_state:
-    #     print x.items()
-    # s = ' '.join([x.items()[0][0] for x in start_state])
-    # state_map[s] = []  # add 1st state
-
-    # Algo:
-    #######
-    new_states, new_edges = game_states_from2(start_state, game_struct, state_map, edges)
-    temp = []
-    for item in new_states.keys():  # takes the string
-        print "item: ", item
-        if item not in state_map:
-            state_map[item] = len(state_map) + 1
-            # states[item]
-            temp.append(item)
-
-    print "temp ", temp
-    while temp:  # while not empty...
-        item = temp.pop(0)
-        print "temp item: ", item
-
-        st = [{x: k} for x, k in zip(g_struct['status_keys'], item.split(' '))]
-        print "st: ", st
-        new_states, new_edges = game_states_from2(st, game_struct, state_map, edges)
-        for item in new_states.keys():  # takes the string
-            if item not in state_map and item not in state_map:  # if not existent, mark it and go
-                # through it
-                state_map[item] = len(state_map) + 1
-                # states[item]
-                temp.append(item)
-
-        print "temp ", temp
-        print "temp len: ", len(temp)
-
-    print "states: ", state_map
-    print len(state_map)
-    return state_map
-
-
-def get_bforce_graph(all_permutations, game_struct):
+    codec = StateCodec(game_struct)
+    program = compile_rules(game_struct, codec)
+
+    start = _as_code(start_state, codec)
+    if state_map.get(start, None) is None:
+        state_map[start] = len(state_map) + 1
+
+    for src, dst, rule_op in bfs_edges(game_struct, start, max_depth=how_many, program=program,
+                                       codec=codec):
+        dst_id = state_map.get(dst, None)
+        if dst_id is None:
+            dst_id = state_map[dst] = len(state_map) + 1
+
+        edges.append((state_map[src], dst_id, rule_op))
+
+    return state_map, edges
+
+
+def card_in(codec, card, key='T'):
+    """
+    Goal predicate: the given card is in the given position.
+
+    :param codec: the StateCodec of the game
+    :param card: the card value, e.g. '2H'
+    :param key: the position, one of the 'status_keys'
+    :return: a function of the encoded state
+    """
+    index = codec.status_keys.index(key)
+    code = codec.code[card]
+    return lambda state: state[index] == code
+
+
+def ttt_heuristic(codec, card):
+    """
+    Admissible heuristic for the TTT goal 'card in T': 0 moves when the card is already in T,
+    at least 1 when it is in the keeper position of the current player (the T move), at least 2
+    otherwise since it has to reach that position first.
+
+    :param codec: the StateCodec of the TTT game
+    :param card: the goal card value, e.g. '2H'
+    :return: a function of the encoded state
+    """
+    keys = codec.status_keys
+    t, pl = keys.index('T'), keys.index('PL')
+    keeper = dict((codec.code[k], keys.index(k)) for k in ('CK', 'NK'))
+    code = codec.code[card]
+
+    def h(state):
+        if state[t] == code:
+            return 0
+        if state[keeper[state[pl]]] == code:
+            return 1
+        return 2
+
+    return h
+
+
+def solve(game_struct, start_state, is_goal, heuristic=None, max_states=None, program=None,
+          codec=None):
+    """
+    A* search of the shortest move sequence from a state to a goal one, touching only the states
+    needed to prove it optimal. Without heuristic it is a plain breadth-first search.
+
+    :param game_struct: a structure defining the game in terms of states, values, rules and
+        constraints
+    :param start_state: a list of dictionaries key/value of the start state or the encoded state
+    :param is_goal: predicate of the encoded state, see card_in
+    :param heuristic: admissible and consistent estimate of the moves left, see ttt_heuristic
+    :param max_states: give up after visiting this many states. Default: no limit
+    :param program: the game rules compiled by compile_rules
+    :param codec: the StateCodec used by the program
+    :return: a triplet (length, moves, visited): the number of moves, the list of rule
+    operations and the number of visited states. Length and moves are None when no goal state is
+    reachable within the budget.
+    """
+    if codec is None:
+        codec = StateCodec(game_struct)
+    if program is None:
+        program = compile_rules(game_struct, codec)
+    if heuristic is None:
+        heuristic = lambda state: 0
+
+    start = _as_code(start_state, codec)
+    parent = {start: None}  # state -> (previous state, rule)
+    cost = {start: 0}
+    counter = 0  # tie breaker: first in, first out among equal estimates
+    heap = [(heuristic(start), counter, start)]
+
+    while heap:
+        f, i, state = heappop(heap)
+        g = cost[state]
+        if f > g + heuristic(state):
+            continue  # stale entry
+
+        if is_goal(state):
+            moves = []
+            while parent[state] is not None:
+                state, rule_op = parent[state]
+                moves.append(rule_op)
+            moves.reverse()
+            return len(moves), moves, len(cost)
+
+        for rule_op, next_state in _successors(state, program):
+            if next_state not in cost or g + 1 < cost[next_state]:
+                if next_state not in cost and max_states is not None and \
+                        len(cost) >= max_states:
+                    continue
+                cost[next_state] = g + 1
+                parent[next_state] = (state, rule_op)
+                counter += 1
+                heappush(heap, (g + 1 + heuristic(next_state), counter, next_state))
+
+    return None, None, len(cost)
+
+
+def score_hands(game_struct, hands, card, key='T', heuristic=None):
+    """
+    Number of moves each hand needs to bring the card in the given position.
+
+    :param game_struct: the game structure
+    :param hands: sequence of start states (value sequences)
+    :param card: the goal card value
+    :param key: the goal position
+    :param heuristic: optional factory of the A* heuristic, called as heuristic(codec, card), e.g.
+        ttt_heuristic. It must be admissible for the rules of game_struct, or the scores may not
+        be the shortest ones (ttt_heuristic is for the TTT rules and the 'T' position only).
+        Default: no heuristic, a plain uniform cost search
+    :return: a list with the number of moves for each hand, None when unreachable
+    """
+    codec = StateCodec(game_struct)
+    program = compile_rules(game_struct, codec)
+    is_goal = card_in(codec, card, key)
+    if heuristic is not None:
+        heuristic = heuristic(codec, card)
+
+    return [solve(game_struct, hand, is_goal, heuristic, program=program, codec=codec)[0]
+            for hand in hands]
+
+
+_worker_game = None  # (codec, program) of the worker processes, see _init_bforce_worker
+
+
+def _init_bforce_worker(game_struct, rule_ops):
+    """
+    Compile the game rules once in each worker process. Compiled lambdas cannot be pickled, hence
+    the structure is compiled again and the parent rule order is enforced.
+    """
+    global _worker_game
+    codec = StateCodec(game_struct)
+    program = compile_rules(game_struct, codec)
+    program.sort(key=lambda item: rule_ops.index(item[0]))
+    _worker_game = (codec, program)
+
+
+def _expand_bforce_shard(shard):
+    """
+    Expand a shard of permutations in a worker process, indexing the states met in a shard-local
+    map, so that just integer arrays go back to the parent.
+
+    :param shard: a list of state permutations
+    :return: a tuple of arrays (states, src, dst, rule): states holds the encoded states in order
+    of first appearance (sources and successors, as the serial expansion meets them), src and dst
+    index it and rule indexes the worker rule order
+    """
+    codec, program = _worker_game
+    rule_index = dict((rule_op, i) for i, (rule_op, steps) in enumerate(program))
+    local = {}
+    src, dst, rule = [], [], []
+    for item in shard:
+        status = codec.encode(item)
+        old_id = local.setdefault(status, len(local))
+        for rule_op, next_state in _successors(status, program):
+            src.append(old_id)
+            dst.append(local.setdefault(next_state, len(local)))
+            rule.append(rule_index[rule_op])
+
+    states = np.zeros((len(local), len(codec.status_keys)), dtype=np.uint8)
+    for status, i in local.iteritems():
+        states[i] = status
+
+    return (states, np.array(src, dtype=np.int32), np.array(dst, dtype=np.int32),
+            np.array(rule, dtype=np.uint8))
+
+
+def _shards(items, shard_size):
+    """
+    Split an iterable into lists of shard_size items, without materializing it.
+    """
+    items = iter(items)
+    return iter(lambda: list(islice(items, shard_size)), [])
+
+
+def get_bforce_graph(all_permutations, game_struct, processes=None, shard_size=2000):
     """
     Generate the game graph from the state permutations.
 
-    :param all_permutations: state permutations of a game
+    :param all_permutations: state permutations of a game (any iterable: the parallel expansion
+        streams it in shards)
     :param game_struct: a structure defining the game in terms of states, values, rules and
         constraints
-    :return:  a pair (dictionary, list) respectively mapping state values to unique index and
-    listing triplets as (state_i, state_j, rule)
+    :param processes: number of worker processes sharing the permutations. Default: serial
+    :param shard_size: number of permutations each worker expands at a time
+    :return:  a pair (dictionary, list) respectively mapping encoded states to unique index and
+    listing triplets as (state_i, state_j, rule). The parallel and serial outputs are identical.
     """
     state_map = {}
     edges = []
+    codec = StateCodec(game_struct)
+    program = compile_rules(game_struct, codec)
+
+    if not processes or processes < 2:
+        for item in all_permutations:
+            game_states_from2(codec.encode(item), game_struct, state_map, edges, program, codec)
+
+        return state_map, edges
+
+    if len(codec.values) > np.iinfo(np.uint8).max + 1:
+        raise ValueError("Too many values for the parallel expansion: %d" % len(codec.values))
+    rule_ops = [rule_op for rule_op, steps in program]
+
+    pool = Pool(processes, initializer=_init_bforce_worker, initargs=(game_struct, rule_ops))
+    try:
+        # shard results come back in order and their local states are in order of first
+        # appearance: merging them sequentially assigns the very same indexes of the serial
+        # expansion. Just the states new to a shard are looked up in the global map.
+        for states, src, dst, rule in pool.imap(_expand_bforce_shard,
+                                                _shards(all_permutations, shard_size)):
+            ids = np.zeros(len(states), dtype=np.int64)
+            for i, status in enumerate(map(tuple, states.tolist())):
+                global_id = state_map.get(status, None)
+                if global_id is None:
+                    global_id = state_map[status] = len(state_map) + 1
+                ids[i] = global_id
+
+            edges.extend(zip(ids[src].tolist(), ids[dst].tolist(),
+                             [rule_ops[r] for r in rule.tolist()]))
+    finally:
+        pool.close()
+        pool.join()
 
-    for item in all_permutations:
-        st = [{x: k} for x, k in zip(g_struct['status_keys'], item)]
-        n, e = game_states_from2(st, game_struct, state_map, edges)
-
-    print "state_map: ", state_map
-    print "edges: ", edges
     return state_map, edges
 
 
-def get_TTT_bforce_graph(game_struct):
+def get_TTT_bforce_graph(game_struct, processes=None):
     """
     Genrate a TTT game graph using all state permutations.
 
     :param game_struct: a structure defining the game in terms of states, values, rules and
         constraints
-    :return:  a pair (dictionary, list) respectively mapping state values to unique index and
+    :param processes: number of worker processes, see get_bforce_graph. Default: serial
+    :return:  a pair (dictionary, list) respectively mapping encoded states to unique index and
     listing triplets as (state_i, state_j, rule)
     """
     l = list(permutations(['2C', '2H', '3C', '3H', '4C', '4H']))
@@ -323,10 +610,78 @@ def get_TTT_bforce_graph(game_struct):
     l2 = [item + ('CK',) for item in l]
     l3 = l1 + l2
 
-    n, e = get_bforce_graph(all_permutations=l3, game_struct=game_struct)
+    n, e = get_bforce_graph(all_permutations=l3, game_struct=game_struct, processes=processes)
     return n, e
 
 
+def deck_struct(game_struct, numbers, suits=(('C', 'black'), ('H', 'red'))):
+    """
+    Make a variant of a card game structure with a different deck: one card for each number and
+    suit, named like '2C'.
+
+    :param game_struct: the game structure to copy
+    :param numbers: the card numbers
+    :param suits: pairs (suit, color)
+    :return: a new game structure sharing the rules of the given one
+    """
+    keys = game_struct['status_keys']
+    elements = dict((k, v) for k, v in game_struct['elements'].items() if k in keys)
+    for number in numbers:
+        for suit, color in suits:
+            elements['%d%s' % (number, suit)] = {'color': color, 'number': number}
+
+    struct = dict(game_struct)
+    struct['elements'] = elements
+    return struct
+
+
+def _deck_layout(game_struct):
+    """
+    Split the positions of the state into card positions and extra feature positions.
+
+    :return: a triplet (cards, card_slots, feature_slots): the sorted card values, the indexes of
+    the card positions and a list of pairs (index, domain) for the extra feature positions.
+    """
+    keys = game_struct['status_keys']
+    elements = game_struct['elements']
+    cards = sorted([k for k in elements.keys() if k not in keys])
+    card_slots = [i for i, k in enumerate(keys) if k not in elements]
+    feature_slots = [(i, elements[k]['values']) for i, k in enumerate(keys) if k in elements]
+    return cards, card_slots, feature_slots
+
+
+def estimate_states(game_struct):
+    """
+    Number of states of the brute-force graph: card permutations times the extra feature values.
+    """
+    cards, card_slots, feature_slots = _deck_layout(game_struct)
+    n = 1
+    for i in range(len(card_slots)):
+        n *= len(cards) - i
+    for i, domain in feature_slots:
+        n *= len(domain)
+
+    return max(n, 0)
+
+
+def deck_permutations(game_struct):
+    """
+    Generate every state of the game: the cards of game_struct['elements'] arranged in the card
+    positions in every possible way, for every value of the extra feature positions.
+
+    :return: a generator of value tuples following the 'status_keys' order
+    """
+    cards, card_slots, feature_slots = _deck_layout(game_struct)
+    state = [None] * len(game_struct['status_keys'])
+    for features in product(*[domain for i, domain in feature_slots]):
+        for (i, domain), value in zip(feature_slots, features):
+            state[i] = value
+        for perm in permutations(cards, len(card_slots)):
+            for i, value in zip(card_slots, perm):
+                state[i] = value
+            yield tuple(state)
+
+
 # a list of dictionaries stating card position and card value in the TTT case.
 # the order is given by the game structure 'status_keys' list.
 # each dictionary is then enriched by the features in the game structure.
@@ -341,6 +696,7 @@ if __name__ == '__main__':
     state_map = {}
     edges = []
     get_game_graph(st, g_struct, state_map, edges)
+    print "states: %d, edges: %d" % (len(state_map), len(edges))
     # print list(permutations(['2C','2H','3C','3H','4C','4H']))
 
     print "generating brute force graph"
@@ -0,0 +1,135 @@
+from graph_tool import Graph
+from game_gen import StateCodec, get_TTT_bforce_graph, g_struct
+from game_vec import VectorEngine
+from game_sym import SymmetryReducer
+import numpy as np
+
+__author__ = 'Gian Paolo Jesi'
+
+"""
+Builds graph_tool graphs straight from the output of the game generators, without going through
+the text matrix files. Edges are committed as NumPy arrays and the state positions and moves are
+stored as small int properties: the 'values' and 'moves' graph properties map them back to the
+strings.
+"""
+
+
+def make_graph(states, src, dst, move, moves, codec):
+    """
+    Make a graph from array-backed generator output, see game_vec.VectorEngine.graph.
+
+    :param states: (n_states, n_slots) uint8 array of encoded states
+    :param src: source state index of each edge
+    :param dst: target state index of each edge
+    :param move: move index of each edge
+    :param moves: list of the move names
+    :param codec: the StateCodec of the game
+    :return: a Graph with an uint8 vertex property for each status key (lowercase names) and an
+    uint8 edge property 'move'
+    """
+    g = Graph()
+    g.add_vertex(len(states))
+    g.add_edge_list(np.column_stack((src, dst)))
+
+    for i, key in enumerate(codec.status_keys):
+        prop = g.new_vertex_property('uint8_t')
+        prop.a[:] = states[:, i]
+        g.vertex_properties[key.lower()] = prop
+
+    g.edge_properties['move'] = g.new_edge_property('uint8_t')
+    g.edge_properties['move'].a[:] = move
+
+    g.graph_properties['status_keys'] = g.new_graph_property('vector<string>', codec.status_keys)
+    g.graph_properties['values'] = g.new_graph_property('vector<string>', codec.values)
+    g.graph_properties['moves'] = g.new_graph_property('vector<string>', moves)
+
+    return g
+
+
+def make_graph_from_map(state_map, edges, game_struct, codec=None):
+    """
+    Make a graph from the (state_map, edges) pair of the Python generators, see
+    game_gen.get_game_graph. Vertex i is the state with index i + 1.
+
+    :param state_map: maps encoded states to 1-based indexes
+    :param edges: list of triplets (state_i, state_j, rule)
+    :param game_struct: the game structure
+    :param codec: the StateCodec used by the generator
+    :return: a Graph, see make_graph
+    """
+    if codec is None:
+        codec = StateCodec(game_struct)
+
+    moves = list(game_struct['rules'].keys())
+    move_index = dict((m, i) for i, m in enumerate(moves))
+
+    states = np.zeros((len(state_map), len(codec.status_keys)), dtype=np.uint8)
+    for state, index in state_map.items():
+        states[index - 1] = state
+
+    edge_array = np.array([(a - 1, b - 1, move_index[m]) for a, b, m in edges],
+                          dtype=np.int64).reshape(-1, 3)
+
+    return make_graph(states, edge_array[:, 0], edge_array[:, 1], edge_array[:, 2], moves, codec)
+
+
+def game_graph(game_struct, start_states, max_depth=None, symmetric=False, cache=None):
+    """
+    Generate the state graph with the vectorized engine and make a Graph of it.
+
+    :param game_struct: the game structure
+    :param start_states: sequence of start states (value sequences), see VectorEngine.graph
+    :param max_depth: states at this distance from the start ones are not expanded.
+    :param symmetric: generate just the quotient graph under the game symmetries, see
+        game_sym.SymmetryReducer. The uint8 edge property 'element' stores the group element
+        mapping each target vertex to the actual target state.
+    :param cache: a graph_cache.GraphCache storing the generated arrays. Not used along with
+        symmetric.
+    :return: a Graph, see make_graph
+    """
+    if cache is not None and not symmetric:
+        arrays, meta = cache.state_graph(game_struct, start_states, max_depth)
+        return make_graph(*arrays, moves=meta['moves'], codec=StateCodec(game_struct))
+
+    engine = VectorEngine(game_struct)
+    if not symmetric:
+        states, src, dst, move = engine.graph(start_states, max_depth)
+        return make_graph(states, src, dst, move, engine.moves, engine.codec)
+
+    reducer = SymmetryReducer(game_struct, engine=engine)
+    states, src, dst, move, element = reducer.quotient_graph(start_states, max_depth)
+    g = make_graph(states, src, dst, move, engine.moves, engine.codec)
+    g.edge_properties['element'] = g.new_edge_property('uint8_t')
+    g.edge_properties['element'].a[:] = element
+    return g
+
+
+def state_labels(g):
+    """
+    Make a string vertex property with the blank separated values of each state, for drawing.
+    """
+    values = list(g.graph_properties['values'])
+    columns = [g.vertex_properties[key.lower()] for key in g.graph_properties['status_keys']]
+    labels = g.new_vertex_property('string')
+    for v in g.vertices():
+        labels[v] = ' '.join([values[prop[v]] for prop in columns])
+
+    return labels
+
+
+def move_labels(g):
+    """
+    Make a string edge property with the move names, for drawing.
+    """
+    moves = list(g.graph_properties['moves'])
+    move = g.edge_properties['move']
+    labels = g.new_edge_property('string')
+    for e in g.edges():
+        labels[e] = moves[move[e]]
+
+    return labels
+
+
+if __name__ == '__main__':
+    state_map, edges = get_TTT_bforce_graph(g_struct)
+    print "TTT graph: ", make_graph_from_map(state_map, edges, g_struct)
@@ -8,9 +8,10 @@ class GameEngine(object):
     Basic game engine class. Implements the interface defined by the GameManager.
     """
 
-    def __init__(self, struct):
+    def __init__(self, struct, cache=None):
         self.struct = struct
         self.start_state = None
+        self.cache = cache
 
     def play_move(self, move, current_state=None):
         if current_state:
@@ -27,6 +28,19 @@ class GameEngine(object):
             return None
 
     def get_graph(self, start_state=None, how_many=None):
+        if start_state and self.cache is not None:
+            # cached states are indexed in the same breadth-first order of get_game_graph
+            (states, src, dst, move), meta = self.cache.state_graph(self.struct, [start_state],
+                                                                    how_many)
+            moves = [str(m) for m in meta['moves']]
+            state_map = dict((tuple(row), i + 1) for i, row in enumerate(states.tolist()))
+            edges = [(a + 1, b + 1, moves[m]) for a, b, m in zip(src.tolist(), dst.tolist(),
+                                                                  move.tolist())]
+            return state_map, edges
+
+        if start_state:
+            return get_game_graph(start_state, self.struct, dict(), [], how_many)
+
         return get_TTT_bforce_graph(self.struct)
 
 
@@ -35,12 +49,13 @@ class GameManager(object):
     Factory class for game engines. At the manger level, the state is a list of strings.
     """
 
-    def __init__(self, game_struct):
+    def __init__(self, game_struct, cache=None):
         self.struct = game_struct
         self.game = None
+        self.cache = cache
 
     def generate_game(self):
-        self.game = GameEngine(self.struct)
+        self.game = GameEngine(self.struct, self.cache)
 
     def get_graph(self, start_state=None):
         if self.game:
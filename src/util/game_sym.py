@@ -0,0 +1,157 @@
+from itertools import permutations, product
+from game_vec import VectorEngine, trace_lambda
+import numpy as np
+
+__author__ = 'Gian Paolo Jesi'
+
+"""
+Symmetry reduction of the game state space. Relabeling the values of a card feature (e.g. swapping
+the black and red suits, or the numbers) maps game states into game states with the very same
+moves, as long as the rules only compare that feature for equality between positions. Each state
+is mapped to the canonical representative of its class (the smallest packed key among its images)
+and only the quotient graph is generated: the full graph can be rebuilt on demand.
+"""
+
+
+def symmetric_features(game_struct):
+    """
+    Detect the card features the rules only compare between positions. Features compared against
+    constants are excluded, and so are the whole card values when compared against a card.
+
+    :param game_struct: the game structure
+    :return: a sorted list of feature names
+    """
+    n_slots = len(game_struct['status_keys'])
+    compared, fixed = set(), set()
+    for rule_op in game_struct['rules']:
+        for rule_seq in game_struct['rules'][rule_op]:
+            for rule in rule_seq:
+                if rule.split()[0] != 'lambda':
+                    continue
+                for conds, perm in trace_lambda(rule, n_slots):
+                    for lhs, rhs, outcome in conds:
+                        if isinstance(rhs, tuple):
+                            compared.add(lhs[1])
+                            compared.add(rhs[1])
+                        else:
+                            fixed.add(lhs[1])
+                            if lhs[1] == 'value' and rhs in game_struct['elements']:
+                                raise ValueError("Rule '%s' refers to a specific card." % rule)
+
+    return sorted(compared - fixed - set(['value']))
+
+
+class SymmetryReducer(object):
+    """
+    Generates the quotient state graph of a permutation game under the relabeling of the
+    symmetric card features, see symmetric_features.
+    """
+
+    def __init__(self, game_struct, features=None, engine=None):
+        self.engine = engine if engine is not None else VectorEngine(game_struct)
+        if features is None:
+            features = symmetric_features(game_struct)
+        self.features = list(features)
+        codec = self.engine.codec
+
+        cards = [elem for elem in codec.elements
+                 if all([f in elem for f in self.features])]
+        by_features = dict((tuple([elem[f] for f in self.features]), elem['code'])
+                           for elem in cards)
+        domains = [sorted(set([elem[f] for elem in cards])) for f in self.features]
+
+        # every combination of the feature relabelings that maps cards into cards:
+        tables = []
+        for perms in product(*[list(permutations(d)) for d in domains]):
+            relabel = dict()
+            for f, domain, perm in zip(self.features, domains, perms):
+                relabel[f] = dict(zip(domain, perm))
+
+            table = self.engine.identity.copy()
+            for key, code in by_features.items():
+                image = tuple([relabel[f][v] for f, v in zip(self.features, key)])
+                if image not in by_features:
+                    break
+                table[code] = by_features[image]
+            else:
+                tables.append(table)
+
+        self.group = np.array(tables, dtype=np.uint8)
+
+    def images(self, states):
+        """
+        Apply every group element to a batch of states.
+
+        :param states: (n_states, n_slots) uint8 array of encoded states
+        :return: a (n_group, n_states, n_slots) array
+        """
+        return self.group[:, states]
+
+    def canonical(self, states):
+        """
+        Map each state to the representative of its class.
+
+        :param states: (n_states, n_slots) uint8 array of encoded states
+        :return: a pair (canonical states, element) where element is the index of the group
+        element mapping the representative back to the state: state = group[element][canonical]
+        """
+        images = self.images(states)
+        keys = np.array([self.engine.pack(image) for image in images])
+        best = np.argmin(keys, axis=0)
+        canon = images[best, np.arange(len(states))]
+        return canon, self.inverse[best]
+
+    @property
+    def inverse(self):
+        """
+        Index of the inverse of each group element.
+        """
+        if not hasattr(self, '_inverse'):
+            index = dict((table.tostring(), i) for i, table in enumerate(self.group))
+            inv = np.argsort(self.group, axis=1).astype(np.uint8)
+            self._inverse = np.array([index[table.tostring()] for table in inv])
+
+        return self._inverse
+
+    def quotient_graph(self, start_states, max_depth=None):
+        """
+        Generate the quotient graph reachable from the given states, level by level.
+
+        :param start_states: a sequence of states (value sequences) or an uint8 array
+        :param max_depth: states at this distance from the start ones are not expanded.
+        :return: a tuple of arrays (states, src, dst, move, dst_element): states holds the
+        canonical states, src, dst and move are as in VectorEngine.graph and the actual target of
+        each edge is group[dst_element][states[dst]].
+        """
+        engine = self.engine
+        if not isinstance(start_states, np.ndarray):
+            start_states = engine.encode(start_states)
+
+        return engine.graph(self.canonical(start_states)[0], max_depth, self.canonical)
+
+    def expand(self, states, src, dst, move, dst_element):
+        """
+        Rebuild the full graph from the quotient one: every group element is applied to every
+        state and edge. The result is the graph reachable from the classes of the start states.
+
+        :return: a tuple of arrays (states, src, dst, move) as in VectorEngine.graph
+        """
+        engine = self.engine
+        n_slots = engine.n_slots
+
+        all_states = self.images(states).reshape(-1, n_slots)
+        all_keys = engine.pack(all_states)
+        first = np.unique(all_keys, return_index=True)[1]
+        first.sort()
+        all_states, all_keys = all_states[first], all_keys[first]
+
+        actual_dst = self.group[dst_element[:, None], states[dst]]
+        full_src = engine.lookup(engine.pack(self.images(states[src]).reshape(-1, n_slots)),
+                                  all_keys)
+        full_dst = engine.lookup(engine.pack(self.images(actual_dst).reshape(-1, n_slots)),
+                                  all_keys)
+        edges = np.column_stack((full_src, full_dst, np.tile(move, len(self.group))))
+
+        # states with a non trivial stabilizer get the same edges more than once:
+        edges = edges[np.sort(np.unique(edges, axis=0, return_index=True)[1])]
+        return all_states, edges[:, 0], edges[:, 1], edges[:, 2].astype(np.uint8)
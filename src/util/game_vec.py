@@ -0,0 +1,553 @@
+from itertools import chain, permutations
+from game_gen import StateCodec, _deck_layout, estimate_states
+from bfs import forward_bfs
+import numpy as np
+
+__author__ = 'Gian Paolo Jesi'
+
+"""
+Vectorized game engine for permutation games, like TTT, where every rule moves the values among
+the positions of the state according to a guard on their features.
+
+Each rule sequence of the game structure is traced once: the lambdas are called with symbolic
+arguments, exploring every outcome of their comparisons. The result is a set of alternatives,
+each being a list of feature comparisons (the guard) plus the index permutation of the positions
+and the value rotations of the 'next' statements. Whole batches of states, stored as
+(n_states, n_slots) uint8 arrays of codes (see game_gen.StateCodec), are then moved at once by
+NumPy fancy indexing.
+"""
+
+
+BFORCE_LIMIT = 5000000  # deck_graph brute-forces games up to this many states
+
+
+class _Tracer(object):
+    """
+    Drives a lambda through one path of its comparisons. Pending decisions are True first.
+    """
+
+    def __init__(self, choices):
+        self.choices = choices
+        self.position = 0
+        self.conditions = []
+
+    def decide(self, lhs, rhs):
+        if self.position < len(self.choices):
+            value = self.choices[self.position]
+        else:
+            value = True
+            self.choices.append(value)
+
+        self.position += 1
+        self.conditions.append((lhs, rhs, value))
+        return value
+
+
+class _Feature(object):
+    """
+    Symbolic feature of a lambda argument: slot[feature].
+    """
+
+    def __init__(self, tracer, slot, feature):
+        self.tracer = tracer
+        self.slot = slot
+        self.feature = feature
+
+    def __eq__(self, other):
+        if isinstance(other, _Feature):
+            return self.tracer.decide((self.slot, self.feature), (other.slot, other.feature))
+
+        return self.tracer.decide((self.slot, self.feature), other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+
+class _Slot(object):
+    """
+    Symbolic argument of a lambda, standing for the value at a position of the state.
+    """
+
+    def __init__(self, tracer, slot):
+        self.tracer = tracer
+        self.slot = slot
+
+    def __getitem__(self, feature):
+        return _Feature(self.tracer, self.slot, feature)
+
+
+def trace_lambda(statement, n_slots):
+    """
+    Enumerate the execution paths of a 'lambda ...' rule statement.
+
+    :param statement: the lambda source string
+    :param n_slots: number of positions in the state
+    :return: a list of pairs (conditions, permutation). Conditions is a list of triplets
+    (lhs, rhs, outcome) where lhs is a (slot, feature) pair and rhs is either a (slot, feature)
+    pair or a constant. Permutation lists the input slot of each output slot, or it is None
+    when the path returns None (the guard does not hold).
+    """
+    f = eval(statement)
+    paths = []
+    choices = []
+    while True:
+        tracer = _Tracer(choices)
+        try:
+            result = f(*[_Slot(tracer, i) for i in range(n_slots)])
+        except Exception as e:
+            raise ValueError("Rule '%s' cannot be vectorized: %s" % (statement, e))
+
+        if result is None:
+            perm = None
+        else:
+            if len(result) != n_slots or not all([isinstance(x, _Slot) for x in result]):
+                raise ValueError("Rule '%s' is not a permutation of the state." % statement)
+            perm = [x.slot for x in result]
+
+        paths.append((tracer.conditions, perm))
+
+        # backtrack to the last True decision and flip it:
+        del choices[tracer.position:]
+        while choices and not choices[-1]:
+            choices.pop()
+        if not choices:
+            break
+        choices[-1] = False
+
+    return paths
+
+
+class VectorEngine(object):
+    """
+    Applies the rules of a permutation game to batches of encoded states.
+    """
+
+    def __init__(self, game_struct):
+        self.struct = game_struct
+        self.codec = StateCodec(game_struct)
+        self.n_slots = len(self.codec.status_keys)
+        n_codes = len(self.codec.values)
+        assert n_codes <= 256, "too many values for uint8 states"
+        self.identity = np.arange(n_codes, dtype=np.uint8)
+
+        # a single vocabulary for every feature value, -1 marks a missing feature:
+        self.feature_values = dict()
+        self.features = dict()
+        for elem in self.codec.elements:
+            for feature in elem.keys():
+                if feature != 'code':
+                    self.features[feature] = np.full(n_codes, -1, dtype=np.int32)
+        for elem in self.codec.elements:
+            for feature, table in self.features.items():
+                if feature in elem:
+                    value = self.feature_values.setdefault(elem[feature], len(self.feature_values))
+                    table[elem['code']] = value
+
+        # same rule order of game_gen.compile_rules:
+        self.moves = []
+        self.rules = []
+        for rule_op in game_struct['rules']:
+            self.moves.append(rule_op)
+            for rule_seq in game_struct['rules'][rule_op]:
+                alts = self._compile_seq(rule_seq)
+                if alts is not None:
+                    self.rules.append((len(self.moves) - 1, alts))
+
+        # keys of packed states:
+        self.base = n_codes
+        assert float(n_codes) ** self.n_slots < 2 ** 63, "states too large to be packed"
+        self.weights = self.base ** np.arange(self.n_slots, dtype=np.int64)
+
+    def _compile_seq(self, rule_seq):
+        """
+        Compose the statements of a rule sequence into alternatives (conditions, perm, maps): the
+        output slot i takes maps[i][state[perm[i]]] whenever all the conditions hold.
+        """
+        if not rule_seq:
+            return None
+
+        alts = [([], range(self.n_slots), [self.identity] * self.n_slots)]
+        for rule in rule_seq:
+            splt = rule.split()
+            if splt[0] == 'lambda':
+                paths = trace_lambda(rule, self.n_slots)
+                new_alts = []
+                for conds, perm, maps in alts:
+                    for path_conds, path_perm in paths:
+                        if path_perm is None:
+                            continue  # guard failure: no edge
+
+                        new_conds = list(conds)
+                        for lhs, rhs, outcome in path_conds:
+                            new_conds.append((self._operand(lhs, perm, maps),
+                                              self._operand(rhs, perm, maps), outcome))
+                        new_alts.append((new_conds, [perm[i] for i in path_perm],
+                                         [maps[i] for i in path_perm]))
+                alts = new_alts
+
+            elif splt[0] == 'next':
+                for arg in splt[1:]:
+                    index = self.codec.status_keys.index(arg)
+                    var_values = self.struct['elements'].get(arg, None)
+                    if var_values is None:
+                        continue
+                    successor = self.identity.copy()
+                    domain = var_values['values']
+                    for value, nxt in zip(domain, domain[1:] + domain[:1]):
+                        successor[self.codec.code[value]] = self.codec.code[nxt]
+                    for conds, perm, maps in alts:
+                        maps[index] = successor[maps[index]]
+            else:
+                raise ValueError("Unrecognized operation or statement: %s" % rule)
+
+        return alts
+
+    def _operand(self, operand, perm, maps):
+        """
+        Translate a traced operand into (input slot, lookup table) or a constant feature code.
+        """
+        if isinstance(operand, tuple) and len(operand) == 2 and isinstance(operand[0], int):
+            slot, feature = operand
+            if feature not in self.features:
+                raise ValueError("Unknown feature: %s" % feature)
+            return perm[slot], self.features[feature][maps[slot]]
+
+        return self.feature_values.get(operand, -2)
+
+    def encode(self, states):
+        """
+        Encode a sequence of states (value sequences) into a (n_states, n_slots) uint8 array.
+        """
+        code = self.codec.code
+        return np.array([[code[v] for v in item] for item in states], dtype=np.uint8) \
+            .reshape(-1, self.n_slots)
+
+    def decode(self, states):
+        """
+        Decode a (n_states, n_slots) array into a list of value tuples.
+        """
+        return [self.codec.decode(row) for row in states]
+
+    def pack(self, states):
+        """
+        Pack every state of a (n_states, n_slots) array into a single int64 key.
+        """
+        return states.astype(np.int64).dot(self.weights)
+
+    def expand(self, states, moves=None):
+        """
+        Apply every rule to a batch of states.
+
+        :param states: (n_states, n_slots) uint8 array of encoded states
+        :param moves: apply just the rules of these move indexes. Default: all the rules
+        :return: a triplet of arrays (src, dst, move): src indexes the source row in states,
+        dst is a (n_edges, n_slots) array of next states and move indexes self.moves. Edges are
+        ordered by source and then by rule, as the Python engine does.
+        """
+        selected = moves
+        srcs, dsts, moves = [], [], []
+        for move, alts in self.rules:
+            if selected is not None and move not in selected:
+                continue
+
+            for conds, perm, maps in alts:
+                mask = np.ones(len(states), dtype=bool)
+                for lhs, rhs, outcome in conds:
+                    a = lhs[1][states[:, lhs[0]]]
+                    b = rhs[1][states[:, rhs[0]]] if isinstance(rhs, tuple) else rhs
+                    if outcome:
+                        mask &= a == b
+                    else:
+                        mask &= a != b
+
+                idx = np.nonzero(mask)[0]
+                dst = states[idx][:, perm]
+                for i in range(self.n_slots):
+                    if maps[i] is not self.identity:
+                        dst[:, i] = maps[i][dst[:, i]]
+
+                srcs.append(idx)
+                dsts.append(dst)
+                moves.append(np.full(len(idx), move, dtype=np.uint8))
+
+        if not srcs:
+            return (np.zeros(0, dtype=np.int64), np.zeros((0, self.n_slots), dtype=np.uint8),
+                    np.zeros(0, dtype=np.uint8))
+
+        src = np.concatenate(srcs)
+        order = np.argsort(src, kind='mergesort')
+        return src[order], np.concatenate(dsts)[order], np.concatenate(moves)[order]
+
+    def lookup(self, keys, known_keys):
+        """
+        Map packed keys to the index of the same key in known_keys, -1 when missing.
+        """
+        order = np.argsort(known_keys, kind='mergesort')
+        sorted_keys = known_keys[order]
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return np.where(sorted_keys[pos] == keys, order[pos], -1)
+
+    def graph(self, start_states, max_depth=None, canonical=None):
+        """
+        Generate the state graph reachable from the given states, level by level. States are
+        indexed in breadth-first discovery order, as game_gen.bfs_edges does.
+
+        :param start_states: a sequence of states (value sequences) or an uint8 array. When it
+            lists all the permutations of the game, the result is the brute-force graph.
+        :param max_depth: states at this distance from the start ones are not expanded.
+        :param canonical: optional hook mapping a batch of states to a pair (representative
+            states, element), see extend. The start states must be representatives already.
+        :return: a tuple of arrays (states, src, dst, move): states is the (n_states, n_slots)
+        uint8 array of encoded states, src and dst index it and move indexes self.moves. With a
+        canonical hook the element array of the edges is appended.
+        """
+        if not isinstance(start_states, np.ndarray):
+            start_states = self.encode(start_states)
+
+        first = np.unique(self.pack(start_states), return_index=True)[1]
+        first.sort()
+        return self.extend(start_states[first], 0, max_depth, canonical)
+
+    def extend(self, states, frontier, max_depth=None, canonical=None):
+        """
+        Expand a set of known states, level by level, starting from states[frontier:]. The other
+        states are considered already expanded.
+
+        :param states: (n_states, n_slots) uint8 array of distinct encoded states
+        :param frontier: index of the first state to expand
+        :param max_depth: states at this distance from the frontier ones are not expanded.
+        :param canonical: optional hook mapping a batch of next states to a pair (representative
+            states, element), e.g. game_sym.SymmetryReducer.canonical: the edges then point to
+            the representatives and element is collected for each edge.
+        :return: a tuple of arrays (states, src, dst, move), see graph. Newly discovered states
+        are appended to the given ones. With a canonical hook the element array of the edges is
+        appended.
+        """
+        all_states = states
+        all_keys = self.pack(all_states)
+        srcs, dsts, moves, elements = [], [], [], []
+
+        frontier = (frontier, len(all_keys))
+        depth = 0
+        while frontier[0] < frontier[1] and (max_depth is None or depth < max_depth):
+            src, dst, move = self.expand(all_states[frontier[0]:frontier[1]])
+            if canonical is not None:
+                dst, element = canonical(dst)
+                elements.append(element)
+            all_states, all_keys, ids = _add_states(self, all_states, all_keys, dst)
+            srcs.append(src + frontier[0])
+            dsts.append(ids)
+            moves.append(move)
+            frontier = (frontier[1], len(all_keys))
+            depth += 1
+
+        if not srcs:
+            empty = np.zeros(0, dtype=np.int64)
+            result = all_states, empty, empty, np.zeros(0, dtype=np.uint8)
+            return result if canonical is None else result + (empty,)
+
+        result = all_states, np.concatenate(srcs), np.concatenate(dsts), np.concatenate(moves)
+        return result if canonical is None else result + (np.concatenate(elements),)
+
+
+def changed_moves(old_struct, new_struct):
+    """
+    List the rule operations added, removed or changed between two versions of a game structure.
+    """
+    old_rules, new_rules = old_struct['rules'], new_struct['rules']
+    return sorted([op for op in set(old_rules.keys()) | set(new_rules.keys())
+                   if old_rules.get(op) != new_rules.get(op)])
+
+
+def _add_states(engine, all_states, all_keys, next_states):
+    """
+    Index a batch of next states, appending the unknown ones in order of first appearance.
+
+    :return: a triplet (all_states, all_keys, ids)
+    """
+    next_keys = engine.pack(next_states)
+    ids = engine.lookup(next_keys, all_keys)
+    missing = ids < 0
+    if missing.any():
+        first = np.unique(next_keys[missing], return_index=True)[1]
+        first.sort()
+        all_states = np.concatenate([all_states, next_states[missing][first]])
+        all_keys = np.concatenate([all_keys, next_keys[missing][first]])
+        ids[missing] = engine.lookup(next_keys[missing], all_keys)
+
+    return all_states, all_keys, ids
+
+
+def update_graph(old_struct, new_struct, states, src, dst, move, old_moves, start_states=None,
+                 max_depth=None):
+    """
+    Update a generated state graph after a change of the rules, re-evaluating just the rule
+    operations that changed over the known states.
+    For a reachable-only graph (start_states given) the states that become reachable within
+    max_depth are expanded by every rule and the ones that become unreachable are dropped along
+    with their edges, so that the result holds the same states and edges as a fresh generation.
+    Old states keep their relative order and new states are appended, hence the indexes may
+    differ from the ones of a fresh generation.
+
+    :param old_struct: the game structure the graph was generated with
+    :param new_struct: the changed game structure. Status keys and elements must be the same.
+    :param states: (n_states, n_slots) uint8 array of encoded states, see VectorEngine.graph
+    :param src: source state index of each edge
+    :param dst: target state index of each edge
+    :param move: move index of each edge, in old_moves
+    :param old_moves: the move names of the old graph
+    :param start_states: the start states (value sequences or an uint8 array) of a reachable-only
+        graph. Default: a brute-force graph, whose states are all kept
+    :param max_depth: the depth limit the reachable-only graph was generated with
+    :return: a tuple (graph, moves, added, removed): graph is the updated (states, src, dst,
+    move) tuple, moves the move names (the ones of the new structure followed by the removed
+    ones), added and removed are (n, 3) arrays of (src, dst, move) edges, indexing the states of
+    the updated and of the old graph respectively
+    """
+    if old_struct['status_keys'] != new_struct['status_keys'] or \
+            old_struct['elements'] != new_struct['elements']:
+        raise ValueError("Status keys and elements must not change: regenerate the graph.")
+
+    engine = VectorEngine(new_struct)
+    changed = changed_moves(old_struct, new_struct)
+    moves = engine.moves + [op for op in old_moves if op not in engine.moves]
+    remap = np.array([moves.index(op) for op in old_moves], dtype=np.uint8)
+    move = remap[move]
+
+    changed_ids = np.array([moves.index(op) for op in changed], dtype=np.uint8)
+    old_changed = np.in1d(move, changed_ids)
+    all_keys = engine.pack(states)
+
+    starts = None
+    expanded = np.ones(len(states), dtype=bool)
+    if start_states is not None:
+        if not isinstance(start_states, np.ndarray):
+            start_states = engine.encode(start_states)
+        starts = engine.lookup(engine.pack(start_states), all_keys)
+        if (starts < 0).any():
+            raise ValueError("The start states are not in the graph.")
+        # the states at the depth limit were not expanded:
+        level = forward_bfs(src, dst, len(states), starts)
+        expanded = level >= 0 if max_depth is None else (level >= 0) & (level < max_depth)
+
+    # the changed rules over the expanded states:
+    idx = np.nonzero(expanded)[0]
+    new_src, next_states, new_move = engine.expand(states[idx], set(changed_ids.tolist()))
+    all_states, all_keys, new_dst = _add_states(engine, states, all_keys, next_states)
+
+    edges = np.column_stack((src[~old_changed], dst[~old_changed], move[~old_changed]))
+    edges = np.concatenate([edges, np.column_stack((idx[new_src], new_dst, new_move))])
+    keep = np.ones(len(all_states), dtype=bool)
+
+    if starts is not None:
+        # expand the states now within the depth limit, until none is left:
+        while True:
+            expanded = np.concatenate([expanded, np.zeros(len(all_states) - len(expanded),
+                                                          dtype=bool)])
+            level = forward_bfs(edges[:, 0], edges[:, 1], len(all_states), starts)
+            within = level >= 0 if max_depth is None else (level >= 0) & (level < max_depth)
+            pending = np.nonzero(within & ~expanded)[0]
+            if not len(pending):
+                break
+
+            src_x, next_states, move_x = engine.expand(all_states[pending])
+            all_states, all_keys, dst_x = _add_states(engine, all_states, all_keys, next_states)
+            expanded[pending] = True
+            edges = np.concatenate([edges, np.column_stack((pending[src_x], dst_x, move_x))])
+
+        # drop the unreachable states and the edges leaving the states at the depth limit:
+        keep = level >= 0 if max_depth is None else (level >= 0) & (level <= max_depth)
+        edges = edges[within[edges[:, 0]]]
+
+    new_index = np.cumsum(keep) - 1
+    all_states = all_states[keep]
+    edges = np.column_stack((new_index[edges[:, 0]], new_index[edges[:, 1]], edges[:, 2]))
+    edges = edges[np.argsort(edges[:, 0], kind='mergesort')]
+
+    # report comparing the packed (src, dst, move) keys, in the indexes of the updated graph:
+    def edge_keys(e):
+        return (e[:, 0].astype(np.int64) * len(all_states) + e[:, 1]) * len(moves) + e[:, 2]
+
+    old_edges = np.column_stack((src, dst, move))
+    old_index = np.where(keep[:len(states)], new_index[:len(states)], -1)
+    mapped = np.column_stack((old_index[src], old_index[dst], move))
+    kept = (mapped[:, 0] >= 0) & (mapped[:, 1] >= 0)
+
+    added = edges[~np.in1d(edge_keys(edges), edge_keys(mapped[kept]))]
+    gone = ~kept
+    gone[kept] = ~np.in1d(edge_keys(mapped[kept]), edge_keys(edges))
+    removed = old_edges[gone]
+
+    graph = (all_states, edges[:, 0], edges[:, 1], edges[:, 2].astype(np.uint8))
+    return graph, moves, added, removed
+
+
+def deck_states(engine):
+    """
+    Every state of a card game as an uint8 array, see game_gen.deck_permutations. Permutations
+    are streamed straight into the array.
+
+    :param engine: the VectorEngine of the game
+    :return: a (n_states, n_slots) uint8 array
+    """
+    cards, card_slots, feature_slots = _deck_layout(engine.struct)
+    codes = [engine.codec.code[c] for c in cards]
+    k = len(card_slots)
+    n = estimate_states(engine.struct)
+    for i, domain in feature_slots:
+        n //= len(domain)
+
+    perms = np.fromiter(chain.from_iterable(permutations(codes, k)), dtype=np.uint8,
+                        count=n * k).reshape(n, k)
+
+    blocks = [np.zeros((n, engine.n_slots), dtype=np.uint8)]
+    blocks[0][:, card_slots] = perms
+    for i, domain in feature_slots:
+        new_blocks = []
+        for value in domain:
+            for block in blocks:
+                block = block.copy()
+                block[:, i] = engine.codec.code[value]
+                new_blocks.append(block)
+        blocks = new_blocks
+
+    return np.concatenate(blocks)
+
+
+def deck_graph(game_struct, start_state=None, strategy='auto', bforce_limit=BFORCE_LIMIT,
+               engine=None):
+    """
+    Generate the state graph of a card game with any deck in game_struct['elements'].
+
+    :param game_struct: the game structure, see game_gen.deck_struct
+    :param start_state: start state (value sequence) of the reachable-only strategy. Default: the
+        first state of the brute-force enumeration
+    :param strategy: 'bforce' generates every state, 'reachable' just the states reachable from
+        the start one, 'auto' picks brute-force when the estimated number of states is within
+        bforce_limit
+    :param bforce_limit: see strategy
+    :param engine: the VectorEngine of the game
+    :return: a tuple of arrays (states, src, dst, move), see VectorEngine.graph
+    """
+    if engine is None:
+        engine = VectorEngine(game_struct)
+
+    if strategy == 'auto':
+        strategy = 'bforce' if estimate_states(game_struct) <= bforce_limit else 'reachable'
+
+    if strategy == 'bforce':
+        return engine.graph(deck_states(engine))
+    elif strategy == 'reachable':
+        if start_state is None:
+            cards, card_slots, feature_slots = _deck_layout(game_struct)
+            start_state = [None] * engine.n_slots
+            for i, value in zip(card_slots, cards):
+                start_state[i] = value
+            for i, domain in feature_slots:
+                start_state[i] = domain[0]
+
+        return engine.graph([start_state])
+    else:
+        raise ValueError("Unknown strategy: %s" % strategy)
@@ -0,0 +1,192 @@
+from hashlib import sha1
+from json import dumps, load
+from os import makedirs, rename
+from os.path import join, isdir, dirname, abspath
+from shutil import rmtree
+from tempfile import mkdtemp
+from game_gen import StateCodec, _as_code
+from game_vec import VectorEngine, update_graph
+import numpy as np
+
+__author__ = 'Gian Paolo Jesi'
+
+"""
+Persistent on-disk cache of generated game graphs. A graph is stored as NumPy .npy arrays (states,
+src, dst, move) plus a small JSON file with the vocabularies, in a directory named after a stable
+hash of the game structure and of the generation parameters. Arrays are reloaded memory mapped.
+"""
+
+DEFAULT_CACHE_DIR = join(dirname(dirname(abspath(__file__))), 'data', 'cache')
+_ARRAYS = ('states', 'src', 'dst', 'move')
+_CACHE_FORMAT = 2  # version of the codes and of the on-disk layout, part of every key
+
+
+def encode_start_states(game_struct, start_states):
+    """
+    Encode start states given in any form accepted by game_gen.StateCodec.encode (value sequences
+    or key/value dictionaries); already encoded states are kept.
+
+    :return: a list of lists of codes
+    """
+    codec = StateCodec(game_struct)
+    return [list(_as_code(tuple(item), codec)) for item in start_states]
+
+
+def struct_hash(game_struct, start_states=None, max_depth=None):
+    """
+    Stable hash of the parts of the game structure defining the state graph (rules, elements and
+    status_keys) and of the generation parameters.
+
+    :param game_struct: the game structure
+    :param start_states: sequence of encoded start states, see encode_start_states. None means
+        brute-force.
+    :param max_depth: depth limit of the generation
+    :return: an hex digest string
+    """
+    payload = {
+        'format': _CACHE_FORMAT,
+        'status_keys': game_struct['status_keys'],
+        'rules': game_struct['rules'],
+        'elements': game_struct['elements'],
+        'start_states': [list(item) for item in start_states] if start_states is not None
+        else None,
+        'max_depth': max_depth
+    }
+    return sha1(dumps(payload, sort_keys=True)).hexdigest()
+
+
+class GraphCache(object):
+    """
+    Directory of cached state graphs, one sub directory for each key.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+
+    def path(self, key):
+        return join(self.directory, key)
+
+    def load(self, key, mmap=True):
+        """
+        Load a cached graph.
+
+        :param key: the cache key, see struct_hash
+        :param mmap: memory map the arrays instead of reading them
+        :return: a pair (arrays, meta) where arrays is the tuple (states, src, dst, move) and meta
+        the dictionary saved along, or None when the key is not cached
+        """
+        path = self.path(key)
+        if not isdir(path):
+            return None
+
+        try:
+            with open(join(path, 'meta.json')) as f:
+                meta = load(f)
+            arrays = tuple([np.load(join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+                            for name in _ARRAYS])
+        except (IOError, ValueError) as e:
+            print "Warning: discarding broken cache entry %s: %s" % (path, e)
+            return None
+
+        return arrays, meta
+
+    def save(self, key, arrays, meta):
+        """
+        Store a graph. The entry is written in a private temporary directory and then renamed, so
+        that a concurrent load never sees a partial entry and concurrent writers of the same key
+        do not clash: the first rename wins and the others discard their copy, which holds the
+        same graph. Errors writing the cache (e.g. an unwritable directory) are reported as a
+        warning and ignored.
+
+        :param key: the cache key, see struct_hash
+        :param arrays: the tuple (states, src, dst, move)
+        :param meta: a JSON serializable dictionary
+        """
+        path = self.path(key)
+        temp = None
+        try:
+            if not isdir(self.directory):
+                try:
+                    makedirs(self.directory)
+                except OSError:
+                    if not isdir(self.directory):  # not created by a concurrent writer
+                        raise
+            temp = mkdtemp(prefix=key + '.', suffix='.tmp', dir=self.directory)
+
+            for name, array in zip(_ARRAYS, arrays):
+                np.save(join(temp, name + '.npy'), array)
+            with open(join(temp, 'meta.json'), 'w') as f:
+                f.write(dumps(meta, sort_keys=True))
+
+            if not isdir(path):
+                try:
+                    rename(temp, path)
+                    temp = None
+                except OSError:
+                    if not isdir(path):  # not published by a concurrent writer
+                        raise
+        except EnvironmentError as e:  # IOError, or OSError from makedirs and rename
+            print "Warning: cannot write the graph cache %s: %s" % (path, e)
+        finally:
+            if temp is not None:
+                rmtree(temp, ignore_errors=True)
+
+    def state_graph(self, game_struct, start_states, max_depth=None, mmap=True):
+        """
+        Get the state graph generated by game_vec.VectorEngine.graph, generating and storing it
+        on a cache miss.
+
+        :param game_struct: the game structure
+        :param start_states: sequence of start states, as value sequences or key/value
+            dictionaries
+        :param max_depth: states at this distance from the start ones are not expanded.
+        :param mmap: memory map the cached arrays
+        :return: a pair (arrays, meta): arrays is (states, src, dst, move) and meta holds the
+        'moves', 'values' and 'status_keys' lists
+        """
+        start_states = encode_start_states(game_struct, start_states)
+        key = struct_hash(game_struct, start_states, max_depth)
+        cached = self.load(key, mmap)
+        if cached is not None:
+            return cached
+
+        engine = VectorEngine(game_struct)
+        arrays = engine.graph(np.array(start_states, dtype=np.uint8), max_depth)
+        meta = {
+            'moves': engine.moves,
+            'values': engine.codec.values,
+            'status_keys': engine.codec.status_keys
+        }
+        self.save(key, arrays, meta)
+        return arrays, meta
+
+    def update_state_graph(self, old_struct, new_struct, start_states, max_depth=None):
+        """
+        Get the state graph of a changed game structure reusing the cached graph of the old one:
+        just the changed rule operations are re-evaluated and the states that become unreachable
+        are dropped, see game_vec.update_graph. The result is cached under the new structure: it
+        holds the states and edges of a fresh generation, though its state indexes may differ.
+
+        :param old_struct: the game structure of the cached graph
+        :param new_struct: the changed game structure
+        :param start_states: sequence of start states, see state_graph
+        :param max_depth: depth limit of the cached generation
+        :return: a tuple (arrays, meta, added, removed), see state_graph and
+        game_vec.update_graph. Added and removed are None when the old graph is not cached and
+        the new one is generated from scratch.
+        """
+        start_states = encode_start_states(old_struct, start_states)
+        cached = self.load(struct_hash(old_struct, start_states, max_depth), mmap=False)
+        if cached is None:
+            arrays, meta = self.state_graph(new_struct, start_states, max_depth)
+            return arrays, meta, None, None
+
+        (states, src, dst, move), meta = cached
+        arrays, moves, added, removed = update_graph(old_struct, new_struct, states, src, dst,
+                                                     move, [str(m) for m in meta['moves']],
+                                                     np.array(start_states, dtype=np.uint8),
+                                                     max_depth)
+        meta = dict(meta)
+        meta['moves'] = moves
+        self.save(struct_hash(new_struct, start_states, max_depth), arrays, meta)
+        return arrays, meta, added, removed